@@ -33,7 +33,7 @@ def bewerk_timestamp(df, split=False):
     columns = ["date_time"]
     df["date_time"] = pd.to_datetime(
         df["recording_timestamp"],
-        format="%Y-%m-%dT%H:%M:%S",
+        format="ISO8601",
     )
     df = _sort(df)
 
@@ -51,58 +51,111 @@ def bewerk_timestamp(df, split=False):
 
 
 def _sort(df, sortcols={"entity_id": True, "date_time": True}):
-    """Default sorting of the dataframe."""
+    """Default sorting of the dataframe.
+
+    Geeft altijd een nieuw dataframe, zodat kolommen die daarna worden
+    toegevoegd niet in df terechtkomen. Is df al gesorteerd (met een
+    RangeIndex), dan is dat een ondiepe kopie die de data deelt met df.
+    """
+
+    if _is_sorted(df, sortcols):
+        return df.copy(deep=False)
 
     df = df.sort_values(
         list(sortcols.keys()),
         ascending=list(sortcols.values()),
-    ).reset_index(drop=True)
+        ignore_index=True,
+    )
 
     return df
 
 
+def _is_sorted(df, sortcols):
+    """Check whether df is sorted on sortcols and has a default index."""
+
+    index = df.index
+    if not (isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1):
+        return False
+
+    # Lexicografisch oplopend: per paar opeenvolgende rijen beslist de
+    # eerste kolom die verschilt.
+    undecided = np.ones(max(len(df) - 1, 0), dtype=bool)
+    for col, ascending in sortcols.items():
+        values = df[col].to_numpy()
+        if pd.isna(values).any():
+            return False
+        prev, cur = (
+            (values[:-1], values[1:]) if ascending else (values[1:], values[:-1])
+        )
+        if (undecided & (cur < prev)).any():
+            return False
+        undecided &= cur == prev
+
+    return True
+
+
 def verdeel_in_ritten(df, t_seconden=1800, split_timestamp=False):
-    """Voeg een kolom toe met rit_id."""
+    """Voeg een kolom toe met rit_id.
+
+    Geeft een nieuw dataframe; df krijgt geen kolommen duur en rit_id; er
+    wordt alleen gesorteerd als df nog niet gesorteerd is.
+    """
 
     # Converteer timestamps naar datetime objects.
     df = bewerk_timestamp(df, split=split_timestamp)
 
-    # Bereken de duur tussen punten door row-wise time deltas
-    df_dt = df.groupby("entity_id")["date_time"]
-    df["duur"] = df_dt.diff().fillna(np.timedelta64(0, "s"))
-    df = _sort(df)
-
-    # Wijs een rit_id toe op basis van de time deltas.
-    td = pd.Timedelta(seconds=t_seconden)
-    duur_mask = (df["duur"] >= td).astype(int)
-    df["rit_id"] = 1
-    df["rit_id"] += duur_mask.groupby(df["entity_id"]).cumsum()
-    df = _sort(df)
+    # Bereken de duur tussen punten door row-wise time deltas. df is al
+    # gesorteerd door bewerk_timestamp, dus een nieuwe entity begint waar
+    # entity_id verandert; zo zijn er geen groupby kopieën nodig.
+    entity_id = df["entity_id"].to_numpy()
+    date_time = df["date_time"].to_numpy()
+    nieuw = np.ones(len(df), dtype=bool)
+    np.not_equal(entity_id[1:], entity_id[:-1], out=nieuw[1:])
+    unit, _ = np.datetime_data(date_time.dtype)
+    duur = np.empty(len(df), dtype=f"timedelta64[{unit}]")
+    np.subtract(date_time[1:], date_time[:-1], out=duur[1:])
+    duur[nieuw] = 0
+    df["duur"] = duur
+
+    # Wijs een rit_id toe op basis van de time deltas: het aantal ritstarts
+    # tot en met de rij, min het aantal voor de eerste rij van de entity.
+    td = np.timedelta64(t_seconden, "s")
+    rit_id = np.cumsum(duur >= td)
+    start = np.maximum.accumulate(np.where(nieuw, np.arange(len(df)), 0))
+    rit_id += 1 - rit_id[start]
+    df["rit_id"] = rit_id
 
     return df
 
 
-def aantal_ritten(df):
-    return sum(aantal_ritten_per_persoon(df)[:, 1])
+def aantal_ritten(df, herbereken=True):
+    return sum(aantal_ritten_per_persoon(df, herbereken)[:, 1])
 
 
-def aantal_ritten_per_persoon(df):
-    """Bereken het totaal aantal ritten per persoon"""
-    df_new = verdeel_in_ritten(df)
+def aantal_ritten_per_persoon(df, herbereken=True):
+    """Bereken het totaal aantal ritten per persoon.
+
+    herbereken: verdeel de metingen opnieuw in ritten; met False wordt een
+        bestaande rit_id kolom (bv. van split_in_ritten) gebruikt.
+    """
+
+    if herbereken or "rit_id" not in df.columns:
+        df = verdeel_in_ritten(df)
 
-    unique_ids = np.unique(df_new.entity_id)
+    n_ritten = df.groupby("entity_id")["rit_id"].nunique()
 
-    data = np.ones([len(unique_ids), 2])
-    for i in range(len(unique_ids)):
-        data[i, 0] = unique_ids[i]
-        mask = df_new.entity_id == unique_ids[i]
-        data[i, 1] = df_new[mask].rit_id.values[-1]
+    data = np.ones([len(n_ritten), 2])
+    data[:, 0] = n_ritten.index
+    data[:, 1] = n_ritten
 
     return data
 
 
-def bereken_afstanden(df):
-    """Bereken de afstand tussen opeenvolgende coordinaten."""
+def bereken_afstanden(df, point=dict(lat=52.090695, lon=5.121314)):
+    """Bereken de afstand tussen opeenvolgende coordinaten.
+
+    En de afstand tot point (de Dom), zie geodesic_distance.
+    """
 
     df["afstand_hv"] = haversine(
         df.latitude,
@@ -113,19 +166,21 @@ def bereken_afstanden(df):
     td = np.timedelta64(0, "s")
     df["afstand_hv"] = np.where(df["duur"] == td, 0, df["afstand_hv"])
 
-    df["afstand_gd"] = np.vectorize(calculate_distance, otypes=[np.float64])(
+    afstand_gd = geodesic_distance(
         df.latitude,
         df.longitude,
         df.latitude.shift(),
         df.longitude.shift(),
-        df["duur"],
     )
+    df["afstand_gd"] = np.where(df["duur"] > td, afstand_gd, 0.0)
 
     df["snelheid"] = df["afstand_gd"] / df["duur"].dt.total_seconds()
 
-    df["afstand_dom"] = np.vectorize(calculate_distance_to_point, otypes=[np.float64])(
+    df["afstand_dom"] = geodesic_distance(
         df.latitude,
         df.longitude,
+        point["lat"],
+        point["lon"],
     )
 
     return df
@@ -157,6 +212,88 @@ def haversine(lat1, lon1, lat2, lon2):
     return m
 
 
+def geodesic_distance(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    """Return the geodesic distance in meters on the WGS84 ellipsoid.
+
+    Vectorized version of geopy's geodesic, using the inverse formula of
+    Vincenty. Werkt met arrays en Series; missende coordinaten geven NaN.
+    De enkele paren waarvoor de iteratie niet convergeert (bijna
+    tegenover elkaar op de aarde) worden alsnog met geopy berekend.
+    """
+
+    a = 6378137.0
+    f = 1 / 298.257223563
+    b = (1 - f) * a
+
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *[np.asarray(x, dtype=np.float64) for x in [lat1, lon1, lat2, lon2]]
+    )
+    shape = lat1.shape
+    lat1, lon1, lat2, lon2 = [x.ravel() for x in [lat1, lon1, lat2, lon2]]
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        lam = L
+        active = np.ones(L.shape, dtype=bool)
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(
+                cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam
+            )
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(
+                sin_sigma == 0, 0.0, cosU1 * cosU2 * sin_lam / sin_sigma
+            )
+            cos2_alpha = 1 - sin_alpha**2
+            # Op de evenaar is cos2_alpha 0.
+            cos_2sigma_m = np.where(
+                cos2_alpha == 0, 0.0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha
+            )
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_new = L + (1 - C) * f * sin_alpha * (
+                sigma
+                + C
+                * sin_sigma
+                * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2))
+            )
+            active = np.abs(lam_new - lam) > tol
+            lam = lam_new
+            if not active.any():
+                break
+
+        u2 = cos2_alpha * (a**2 - b**2) / b**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = (
+            B
+            * sin_sigma
+            * (
+                cos_2sigma_m
+                + B
+                / 4
+                * (
+                    cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+                    - B
+                    / 6
+                    * cos_2sigma_m
+                    * (-3 + 4 * sin_sigma**2)
+                    * (-3 + 4 * cos_2sigma_m**2)
+                )
+            )
+        )
+        m = b * A * (sigma - delta_sigma)
+
+    for i in np.flatnonzero(active):
+        m[i] = gd((lat1[i], lon1[i]), (lat2[i], lon2[i])).m
+
+    return m.reshape(shape)[()]
+
+
 def calculate_distance(latitude, longitude, shifted_lat, shifted_lon, duur):
     """Bereken de geodesic distance in meters."""
 
@@ -187,40 +324,35 @@ def split_in_ritten(df, t_seconden=1800):
     add columns with duration, distance and speed.
     """
 
-    df["duur"] = np.timedelta64(0, "s")
-    df["rit_id"] = 0
-    df["afstand"] = 0.0
-    df["snelheid"] = 0.0
-
-    for id, df_id in df.groupby("entity_id"):
-
-        # Calculate the time difference between measurements.
-        df_id["duur"] = df_id["date_time"].diff().fillna(np.timedelta64(0, "s"))
-        # Threshold the time interval to identify new rides.
-        rit_mask = df_id["duur"] >= pd.Timedelta(seconds=t_seconden)
-        df_id["duur"][rit_mask] = np.timedelta64(0, "s")
-
-        # Fill the rit_id column.
-        df_id["rit_id"] = df["rit_id"].max() + 1
-        df_id["rit_id"] += rit_mask.astype(int).cumsum()
-
-        # Calculate the distance between measurements.
-        df_id["afstand"] = haversine(
-            df_id.latitude,
-            df_id.longitude,
-            df_id.latitude.shift(),
-            df_id.longitude.shift(),
-        )
-        df_id["afstand"][rit_mask] = 0.0
+    grouped = df.groupby("entity_id", sort=False)
+
+    # Calculate the time difference between measurements.
+    duur = grouped["date_time"].diff()
+    eerste = duur.isna()
+    # Threshold the time interval to identify new rides.
+    rit_mask = duur >= pd.Timedelta(seconds=t_seconden)
+    df["duur"] = duur.mask(eerste | rit_mask, np.timedelta64(0, "s"))
 
-        # Calculate the speed for each measurement.
-        df_id["snelheid"] = df_id["afstand"] / df_id["duur"].dt.total_seconds()
+    # Number the rides per entity_id, in order of entity_id.
+    nieuw = (eerste | rit_mask).to_numpy()
+    order = np.argsort(df["entity_id"].to_numpy(), kind="stable")
+    rit_id = np.empty(len(df), dtype=np.int64)
+    rit_id[order] = np.cumsum(nieuw[order])
+    df["rit_id"] = rit_id
 
-        # Copy data from entity_id to the collated dataframe.
-        columns = ["duur", "afstand", "snelheid", "rit_id"]
-        for col in columns:
-            df.loc[df_id.index, col] = df_id[col]
+    # Calculate the distance between measurements.
+    afstand = haversine(
+        df.latitude,
+        df.longitude,
+        grouped["latitude"].shift(),
+        grouped["longitude"].shift(),
+    )
+    df["afstand"] = afstand.mask(rit_mask, 0.0)
 
+    # Calculate the speed for each measurement.
+    df["snelheid"] = df["afstand"] / df["duur"].dt.total_seconds()
+
+    columns = ["duur", "afstand", "snelheid", "rit_id"]
     print(f"Added {columns} columns to dataframe.")
 
     return df
@@ -286,41 +418,66 @@ def filter_ritten(
     return df
 
 
-def summary_stats(df):
+def summary_stats(df, periods=[]):
     """Calculate statistics for ride count, duration and distance.
 
     N: total sums, G: averages, M: max of the entity_id's.
+    periods: kolommen zoals ["month", "quarter"]; de statistieken per
+        waarde staan dan ook in het resultaat, bv. stats["month"][3].
     """
 
-    # aantal fietsers
-    N_fietsers = len(np.unique(df.entity_id))
-
-    # aantal ritten
-    N_ritten = len(np.unique(df.rit_id))
-    G_ritten = N_ritten / N_fietsers
-    dft = df.loc[:, ["entity_id", "rit_id"]].groupby(["entity_id"]).nunique()
-    M_ritten = int(max(dft["rit_id"]))
-
-    # aantal uren
-    dft = df.loc[:, ["duur"]].sum() / np.timedelta64(1, "h")
-    N_uren = dft.iloc[0]
-    G_uren = N_uren / N_fietsers
-    dft = df.loc[:, ["entity_id", "duur"]].groupby(["entity_id"]).sum()
-    M_uren = int(max(dft["duur"] / np.timedelta64(1, "h")))
-
-    # aantal kilometers
-    dft = df.loc[:, ["afstand"]].sum() / 1000
-    N_km = dft.iloc[0]
-    G_km = N_km / N_fietsers
-    dft = df.loc[:, ["entity_id", "afstand"]].groupby(["entity_id"]).sum()
-    M_km = max(dft["afstand"]) / 1000
-
-    return {
-        "fietsers": {"N": N_fietsers, "G": None, "M": None},
-        "ritten": {"N": N_ritten, "G": G_ritten, "M": M_ritten},
-        "uren": {"N": N_uren, "G": G_uren, "M": M_uren},
-        "afstand": {"N": N_km, "G": G_km, "M": M_km},
-    }
+    # Eén groupby over alle metingen: de duur en afstand per rit en periode.
+    # De rest wordt berekend op deze (veel kleinere) tabel met ritten.
+    keys = list(periods) + ["entity_id", "rit_id"]
+    ritten = df.groupby(keys, observed=True)[["duur", "afstand"]].sum()
+    ritten = ritten.reset_index()
+
+    stats = _stats_per_period(ritten.assign(alle=0), "alle")[0]
+    for period in periods:
+        stats[period] = _stats_per_period(ritten, period)
+
+    return stats
+
+
+def _stats_per_period(ritten, period):
+    """Calculate the summary_stats per value of period from a table of rides."""
+
+    keys = [period, "entity_id", "rit_id"]
+    ritten = ritten.groupby(keys, observed=True)[["duur", "afstand"]].sum()
+    fietsers = ritten.groupby([period, "entity_id"], observed=True).agg(
+        ritten=("duur", "size"),
+        uren=("duur", "sum"),
+        afstand=("afstand", "sum"),
+    )
+    fietsers["uren"] = fietsers["uren"] / np.timedelta64(1, "h")
+    fietsers["afstand"] = fietsers["afstand"] / 1000
+
+    grouped = fietsers.groupby(level=period, observed=True)
+    N, M, N_fietsers = grouped.sum(), grouped.max(), grouped.size()
+
+    stats = {}
+    for value, n_fietsers in N_fietsers.items():
+        N_ritten, N_uren, N_km = N.loc[value, ["ritten", "uren", "afstand"]]
+        stats[value] = {
+            "fietsers": {"N": int(n_fietsers), "G": None, "M": None},
+            "ritten": {
+                "N": int(N_ritten),
+                "G": N_ritten / n_fietsers,
+                "M": int(M.at[value, "ritten"]),
+            },
+            "uren": {
+                "N": N_uren,
+                "G": N_uren / n_fietsers,
+                "M": int(M.at[value, "uren"]),
+            },
+            "afstand": {
+                "N": N_km,
+                "G": N_km / n_fietsers,
+                "M": M.at[value, "afstand"],
+            },
+        }
+
+    return stats
 
 
 def import_knmi_data(
@@ -350,6 +507,7 @@ def import_knmi_data(
 def MCU_preprocessing(
     df,
     error_code_selection=[],
+    error_mask=None,
     rit_splitter_interval=1800,  # s
     ritfilters=dict(
         min_measurements=2,  # #
@@ -359,12 +517,18 @@ def MCU_preprocessing(
         max_average_speed=35,  # km/h
     ),
 ):
-    """Perform standard MCU preprocessing steps."""
+    """Perform standard MCU preprocessing steps.
+
+    error_mask: verwijder metingen op error bits in plaats van op
+        error_code_selection, bv. opschonen.CRITICAL_ERRORS.
+    """
 
     # data processing settings
 
     # Drop the errors.
-    df = opschonen.verwijder_errors(df, error_codes=error_code_selection)
+    df = opschonen.verwijder_errors(
+        df, error_codes=error_code_selection, error_mask=error_mask
+    )
     # Convert timestamps to datetime objects and add dt columns.
     df = bewerk_timestamp(df, split=True)
     # Split measuremnts into rides and add cycle stat columns.
@@ -7,14 +7,107 @@
 """
 
 import requests
+import hashlib
 import json
+import os
+import re
+import threading
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from sys import argv, exit
 from datetime import datetime
 from pathlib import Path
 
-from . import opschonen, analyse
+from . import opschonen, analyse, opslag
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+API_URL = (
+    "https://ckan-dataplatform-nl.dataplatform.nl/api/3/action/datastore_search_sql"
+)
+
+# Kolommen voor keyset paginering: uniek en oplopend binnen een query.
+KEYSET_COLUMNS = ["recording_timestamp", "_id"]
+
+# Bestand met de high-water marks voor sync_csv.
+SYNC_STATE_FILENAME = "sync_state.json"
+
+# Bestand met de afgeronde vensters voor call_api_checkpointed.
+CHECKPOINT_FILENAME = "checkpoints.json"
+
+# De bovengrens van het datumbereik in een SQL statement (zie ResponseCache).
+STOP_CONDITION = re.compile(r"\"recording_timestamp\"\s*(<=?)\s*'([^']+)'")
+
+# Datatypes van de kolommen van de measurement datastore.
+# De sensorwaarden zijn ruwe integers (zie opschonen.CORRECTIE_DEFAULTS).
+# Past een kolom niet in het type, dan wordt een breder type gebruikt.
+MEASUREMENT_SCHEMA = {
+    "_id": "int64",
+    "entity_id": "int64",
+    "recording_timestamp": "datetime64",
+    "receive_timestamp": "datetime64",
+    "acc_max": "int16",
+    "error_code": "int32",
+    "horizontal_accuracy": "int32",
+    "humidity": "int16",
+    "latitude": "float64",
+    "longitude": "float64",
+    "no2": "int16",
+    "pm10": "int16",
+    "pm1_0": "int16",
+    "pm2_5": "int16",
+    "pressure": "int16",
+    "temperature": "int16",
+    "version_major": "int16",
+    "version_minor": "int16",
+    "vertical_accuracy": "int32",
+    "voc": "int16",
+    "voltage": "int16",
+}
+
+# Kolommen die per toepassing worden opgehaald. Zo worden _full_text (alle
+# gegevens nog een keer als string) en ongebruikte kolommen niet verstuurd.
+# De keyset kolommen zitten in elke preset. In query_chunks is "full" alle
+# kolommen van de datastore behalve _full_text (zie full_columns).
+COLUMN_PRESETS = {
+    "full": list(MEASUREMENT_SCHEMA),
+    "analysis": [
+        "_id",
+        "entity_id",
+        "recording_timestamp",
+        "error_code",
+        "latitude",
+        "longitude",
+        "pm1_0",
+        "pm2_5",
+        "pm10",
+        "temperature",
+        "humidity",
+        "pressure",
+        "voltage",
+        "version_major",
+    ],
+    "routefilter": [
+        "_id",
+        "entity_id",
+        "recording_timestamp",
+        "error_code",
+        "latitude",
+        "longitude",
+        "pm1_0",
+        "pm2_5",
+        "pm10",
+        "version_major",
+    ],
+}
 
 
 def is_date_matching(date_str):
@@ -29,41 +122,301 @@ def is_date_matching(date_str):
         return False
 
 
+class ApiError(RuntimeError):
+    """Een api-call is, ook na herhaalde pogingen, mislukt.
+
+    De al opgehaalde gegevens gaan niet verloren:
+    records: de records die al waren opgehaald (gezet door call_api).
+    after: de keyset waarden van het laatst opgehaalde record bij keyset
+        paginering; hervat met call_api(..., after=error.after).
+    offset: de offset van de mislukte chunk bij OFFSET paginering.
+    """
+
+    def __init__(self, msg, records=None, after=None, offset=None):
+        super().__init__(msg)
+        self.records = records if records is not None else []
+        self.after = after
+        self.offset = offset
+
+
+class ResponseCache:
+    """Cache van API-antwoorden op schijf.
+
+    Elk antwoord is een bestand in directory, met als naam de hash van de
+    url, de resource_id, het genormaliseerde SQL statement en de hash van de
+    API key, zodat een antwoord alleen met dezelfde rechten wordt hergebruikt.
+    Antwoorden
+    verlopen na ttl seconden, behalve als de query alleen maanden beslaat
+    die helemaal voorbij zijn: die worden als onveranderlijk bewaard. Wordt
+    de cache groter dan max_bytes, dan worden de minst recent gebruikte
+    antwoorden verwijderd.
+    """
+
+    def __init__(self, directory, ttl=24 * 3600, max_bytes=2 * 1024**3):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        Path.mkdir(self.directory, parents=True, exist_ok=True)
+
+    def path(self, url, params, api_key=""):
+        """Geef het cache bestand van een query."""
+
+        sql = _normalize_sql(params.get("sql", ""))
+        key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()
+        key = json.dumps([url, params.get("resource_id"), sql, key_hash])
+        return Path(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def get(self, url, params, api_key=""):
+        """Geef het opgeslagen antwoord, of None als het er niet (meer) is."""
+
+        p = self.path(url, params, api_key)
+        try:
+            stat = p.stat()
+            expired = time.time() - stat.st_mtime > self.ttl
+            if expired and not _is_immutable(params.get("sql", "")):
+                p.unlink()
+                return None
+            content = p.read_bytes()
+            # atime is het laatste gebruik, mtime het moment van opslaan.
+            os.utime(p, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+
+        return content
+
+    def put(self, url, params, content, api_key=""):
+        """Sla een antwoord op en ruim zo nodig oude antwoorden op."""
+
+        p = self.path(url, params, api_key)
+        p_tmp = p.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        p_tmp.write_bytes(content)
+        p_tmp.replace(p)
+        self.evict()
+
+    def evict(self):
+        """Verwijder de minst recent gebruikte antwoorden boven max_bytes."""
+
+        entries = []
+        for p in self.directory.glob("*.json"):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, p))
+
+        size = sum(entry[1] for entry in entries)
+        for _, n_bytes, p in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            size -= n_bytes
+
+
+def _normalize_sql(sql):
+    """Normalize whitespace, so equivalent statements share a cache key."""
+
+    return " ".join(sql.split()).rstrip(";")
+
+
+def _is_immutable(sql, now=None):
+    """Check whether a query only covers months that are fully in the past."""
+
+    bounds = STOP_CONDITION.findall(sql)
+    if not bounds:
+        return False
+
+    month_start = pd.Timestamp(now or datetime.now()).to_period("M").start_time
+    for op, val in bounds:
+        stop = pd.Timestamp(val)
+        if stop < month_start or (op == "<" and stop == month_start):
+            return True
+
+    return False
+
+
+class CkanClient:
+    """Client voor de CKAN datastore_search_sql API.
+
+    Hergebruikt verbindingen (keep-alive) via een requests.Session met een
+    connection pool. Mislukte calls (verbindingsfouten, timeouts en de
+    status codes in RETRY_STATUS) worden maximaal retries keer opnieuw
+    geprobeerd, met een wachttijd van backoff * 2**poging seconden.
+    Met cache (een ResponseCache of een map) worden antwoorden op schijf
+    bewaard en hergebruikt.
+    """
+
+    RETRY_STATUS = [429, 500, 502, 503, 504]
+
+    def __init__(
+        self,
+        url=API_URL,
+        headers={},
+        retries=5,
+        backoff=1.0,
+        pool_size=10,
+        timeout=300,
+        cache=None,
+    ):
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        if cache is not None and not isinstance(cache, ResponseCache):
+            cache = ResponseCache(cache)
+        self.cache = cache
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_chunk(self, params):
+        """Get a single chunk of (limit=32000) observations."""
+
+        api_key = self.session.headers.get("X-CKAN-API-Key", "")
+        if self.cache is not None:
+            content = self.cache.get(self.url, params, api_key)
+            if content is not None:
+                return decode_json(content)["result"]["records"]
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(
+                    self.url, params=params, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                msg = f"api-call mislukt: {e}"
+            else:
+                if response.status_code == 200:
+                    jfile = decode_json(response.content)
+                    if self.cache is not None:
+                        self.cache.put(self.url, params, response.content, api_key)
+                    return jfile["result"]["records"]
+                msg = f"api-call mislukt:"
+                msg += f" foutcode: {response.status_code};"
+                msg += f" {response.text}"
+                if response.status_code not in self.RETRY_STATUS:
+                    raise ApiError(msg)
+
+            if attempt < self.retries:
+                wait = self.backoff * 2**attempt
+                print(f"{msg}\nNieuwe poging over {wait} s.")
+                time.sleep(wait)
+
+        raise ApiError(msg)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def decode_json(content):
+    """Decode a JSON response body (bytes).
+
+    Gebruikt orjson als dat geinstalleerd is, anders de standaard json module.
+    """
+
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
 def _get_chunk(url, headers, params):
     """Get a single chunk of (limit=32000) observations."""
 
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code != 200:
-        msg = f"api-call mislukt:"
-        msg += f" foutcode: {response.status_code};"
-        msg += f" {response.text}\n"
-        exit()
-    jfile = json.loads(response.text)
-    records = jfile["result"]["records"]
+    with CkanClient(url, headers) as client:
+        return client.get_chunk(params)
 
-    return records
 
+def iter_chunks(client, params, limit=32000, offset=0, workers=1):
+    """Yield the chunks of a query in order.
 
-def get_records(url, headers, params, limit=32000, offset=0):
-    """Get all records for a query."""
+    Met workers > 1 worden telkens workers opeenvolgende OFFSET vensters
+    tegelijk opgehaald in een thread pool. Het SQL statement in params moet
+    een ORDER BY op unieke kolommen hebben, anders kunnen de vensters
+    overlappen of rijen missen.
+    """
 
     sql_base = f'{params["sql"]}'
+    truncated = True
+    i = 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while truncated:
+            windows = [
+                {**params, "sql": f"{sql_base} OFFSET {offset + n * limit}"}
+                for n in range(workers)
+            ]
+            chunks = executor.map(client.get_chunk, windows)
+            for n in range(workers):
+                try:
+                    chunk = next(chunks)
+                except ApiError as e:
+                    e.offset = offset + n * limit
+                    raise
+                truncated = len(chunk) == limit
+                if chunk:
+                    msg = f"Read chunk {i:02d}"
+                    msg += f' up to timestamp {chunk[-1]["recording_timestamp"]}'
+                    print(msg)
+                    i += 1
+                    yield chunk
+                if not truncated:
+                    break
+            offset += workers * limit
+
+
+def get_records(url, headers, params, limit=32000, offset=0, workers=1):
+    """Get all records for a query."""
+
     records = []
+    with CkanClient(url, headers, pool_size=workers) as client:
+        for chunk in iter_chunks(client, params, limit, offset, workers):
+            records += chunk
+
+    return records
+
+
+def iter_chunks_keyset(
+    client, params, sql_args, limit=32000, keyset=KEYSET_COLUMNS, after=None
+):
+    """Yield the chunks of a query in order, using keyset pagination.
+
+    Elke chunk begint na de keyset waarden van het laatste record van de
+    vorige chunk, zodat de database geen rijen hoeft over te slaan (zoals
+    bij OFFSET) en elke chunk evenveel kost. De keyset kolommen moeten in de
+    geselecteerde kolommen zitten.
+
+    after: begin na deze keyset waarden in plaats van bij het begin.
+    """
+
     truncated = True
     i = 1
 
     while truncated:
-        params["sql"] = f"{sql_base} OFFSET {offset}"
-        chunk = _get_chunk(url, headers, params)
+        sql = build_sql_statement(**sql_args, keyset=keyset, after=after)
+        try:
+            chunk = client.get_chunk({**params, "sql": sql})
+        except ApiError as e:
+            e.after = after
+            raise
         truncated = len(chunk) == limit
-        records += chunk
-        offset += limit
-        msg = f"Read chunk {i:02d}"
-        msg += f' up to timestamp {chunk[-1]["recording_timestamp"]}'
-        print(msg)
-        i += 1
-
-    return records
+        if chunk:
+            after = [chunk[-1][col] for col in keyset]
+            msg = f"Read chunk {i:02d}"
+            msg += f' up to timestamp {chunk[-1]["recording_timestamp"]}'
+            print(msg)
+            i += 1
+            yield chunk
 
 
 def build_sql_statement(
@@ -71,16 +424,30 @@ def build_sql_statement(
     datastore="provincie_utrecht_snuffelfiets_measurement_rydruofi",
     conditions=[],
     parameters={},
+    keyset=None,
+    after=None,
 ):
+    """Bouw een SQL statement voor de datastore.
+
+    keyset: kolommen om op te sorteren voor keyset paginering,
+        bijv. ["recording_timestamp", "_id"].
+    after: de keyset waarden van het laatst gelezen record;
+        alleen records daarna worden geselecteerd.
+    """
 
     sql = ""
     sql += f'SELECT {columns} FROM "{datastore}"'
 
-    sql += f" WHERE"
-    for condition in conditions:
-        sql += f' "{condition["col"]}" {condition["op"]} \'{condition["val"]}\''
-        sql += f" AND"
-    sql = sql[:-4]
+    conditions = list(conditions)
+    if keyset and after is not None:
+        conditions += [{"col": keyset, "op": ">", "val": after}]
+
+    if conditions:
+        sql += " WHERE "
+        sql += " AND ".join(_format_condition(c) for c in conditions)
+
+    if keyset:
+        sql += " ORDER BY " + ", ".join(f'"{col}"' for col in keyset)
 
     for k, v in parameters.items():
         sql += f" {k.upper()} {v}"
@@ -88,48 +455,319 @@ def build_sql_statement(
     return sql
 
 
-def call_api(
+def _format_condition(condition):
+    """Format a condition; a list of columns gives a row value comparison."""
+
+    col, op, val = condition["col"], condition["op"], condition["val"]
+
+    if isinstance(col, (list, tuple)):
+        cols = ", ".join(f'"{c}"' for c in col)
+        vals = ", ".join(f"'{v}'" for v in val)
+        return f"({cols}) {op} ({vals})"
+
+    return f'"{col}" {op} \'{val}\''
+
+
+def query_chunks(
     api_key,
     start_datum,
     stop_datum,
-    columns="*",
-    url="https://ckan-dataplatform-nl.dataplatform.nl/api/3/action/datastore_search_sql",
+    columns="full",
+    url=API_URL,
     datastore="provincie_utrecht_snuffelfiets_measurement_rydruofi",
     resource_id="4cfb5177-d3db-4efc-ac6f-351af75f9f92",
     sql_conditions=[],
     sql_parameters={"limit": 32000},  # CKAN limit is 32000 records  , 'offset': 0
+    workers=1,
+    pagination="offset",
+    after=None,
+    client=None,
+    include_start=False,
+    cache=None,
 ):
-    """Doe een query op de database."""
+    """Doe een query op de database en geef de chunks één voor één terug.
+
+    columns: een preset uit COLUMN_PRESETS, een lijst kolommen of een
+        SELECT expressie zoals "*".
+    workers: het aantal chunks dat tegelijk wordt opgehaald.
+    pagination: "offset" of "keyset"; keyset paginering haalt de chunks
+        na elkaar op, maar de kosten per chunk groeien niet met de offset.
+    after: alleen records na deze (recording_timestamp, _id) waarden;
+        dit gebruikt altijd keyset paginering.
+    client: een CkanClient om te hergebruiken; zonder client wordt er een
+        aangemaakt voor url en api_key.
+    include_start: selecteer ook records op precies start_datum, zodat
+        opeenvolgende vensters op elkaar aansluiten.
+    cache: een ResponseCache of een map om antwoorden op schijf te bewaren
+        (alleen zonder client).
+    """
+
+    if after is not None:
+        pagination = "keyset"
+
+    if pagination not in ["offset", "keyset"]:
+        raise ValueError(f"Unknown pagination {pagination!r}.")
+
+    sql_conditions_dates = _date_conditions(start_datum, stop_datum, include_start)
+    sql_conditions_all = sql_conditions + sql_conditions_dates
+
+    headers = {"X-CKAN-API-Key": api_key}
+    limit = sql_parameters["limit"]
+    own_client = client is None
+    if own_client:
+        client = CkanClient(url, headers, pool_size=max(workers, 10), cache=cache)
+
+    try:
+        if isinstance(columns, str) and columns == "full":
+            columns = full_columns(client, datastore, resource_id)
+
+        sql_args = {
+            "columns": _select_columns(columns),
+            "datastore": datastore,
+            "conditions": sql_conditions_all,
+            "parameters": sql_parameters,
+        }
+        # Elk OFFSET venster is een aparte query; zonder ORDER BY kan de
+        # volgorde per query verschillen en kunnen rijen dubbel of niet
+        # worden opgehaald.
+        sql = build_sql_statement(**sql_args, keyset=KEYSET_COLUMNS)
+        params = {"resource_id": resource_id, "sql": sql}
+        print(f'sql statement: {params["sql"]}')
+
+        if pagination == "keyset":
+            yield from iter_chunks_keyset(client, params, sql_args, limit, after=after)
+        else:
+            yield from iter_chunks(client, params, limit, workers=workers)
+    finally:
+        if own_client:
+            client.close()
+
+
+def _date_conditions(start_datum, stop_datum, include_start=False):
+    """Check the dates and build the SQL conditions for the date range.
+
+    De datums zijn jjjj-mm-dd of, voor kleinere vensters, jjjj-mm-ddTuu:mm:ss.
+    """
 
     for k, datum in {"Start": start_datum, "Stop": stop_datum}.items():
-        if not is_date_matching(datum):
+        if not (is_date_matching(datum) or _is_timestamp_matching(datum)):
             msg = f"\n{k}datum {datum} is niet de juiste datumnotatie."
             msg += f" (jjjj-mm-dd). Programma wordt afgebroken.\n"
             exit(msg)
 
-    sql_conditions_dates = [
-        {"col": "recording_timestamp", "op": ">", "val": start_datum},
+    return [
+        {
+            "col": "recording_timestamp",
+            "op": ">=" if include_start else ">",
+            "val": start_datum,
+        },
         {"col": "recording_timestamp", "op": "<", "val": stop_datum},
     ]
-    sql_conditions_all = sql_conditions + sql_conditions_dates
 
-    sql_args = {
-        "columns": columns,
+
+def _is_timestamp_matching(timestamp_str):
+    """Perform timestamp format check."""
+
+    try:
+        return bool(datetime.strptime(timestamp_str, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return False
+
+
+def call_api(api_key, start_datum, stop_datum, **kwargs):
+    """Doe een query op de database.
+
+    Als de download mislukt, bevat de ApiError de al opgehaalde records.
+    Zie query_chunks voor de keyword arguments.
+    """
+
+    start_time = time.time()
+
+    records = []
+    try:
+        for chunk in query_chunks(api_key, start_datum, stop_datum, **kwargs):
+            records += chunk
+    except ApiError as e:
+        e.records = records
+        raise
+
+    df = records_to_frame(records)
+
+    print(f"Read {df.shape[0]} measurements in {time.time() - start_time} s.")
+    print(f"\n")
+
+    return df
+
+
+def call_api_sharded(
+    api_key,
+    start_datum,
+    stop_datum,
+    url=API_URL,
+    datastore="provincie_utrecht_snuffelfiets_measurement_rydruofi",
+    resource_id="4cfb5177-d3db-4efc-ac6f-351af75f9f92",
+    sql_conditions=[],
+    sql_parameters={"limit": 32000},
+    workers=4,
+    shard_unit="hour",
+    cache=None,
+    **kwargs,
+):
+    """Doe een query in tijdvensters (shards) die tegelijk worden opgehaald.
+
+    Eerst wordt het aantal records per uur (shard_unit) opgevraagd. Daarmee
+    wordt het datumbereik opgedeeld in aaneengesloten shards van maximaal
+    limit records, die met workers threads tegelijk worden opgehaald. Een
+    shard die toch groter is, wordt met keyset paginering gelezen. Het
+    resultaat is gesorteerd op (recording_timestamp, _id).
+    Zie query_chunks voor de overige keyword arguments.
+    """
+
+    start_time = time.time()
+
+    limit = sql_parameters["limit"]
+    headers = {"X-CKAN-API-Key": api_key}
+    query_args = {
+        "url": url,
         "datastore": datastore,
-        "conditions": sql_conditions_all,
-        "parameters": sql_parameters,
+        "resource_id": resource_id,
+        "sql_conditions": sql_conditions,
+        "sql_parameters": sql_parameters,
     }
-    headers = {"X-CKAN-API-Key": api_key}
-    params = {"resource_id": resource_id, "sql": build_sql_statement(**sql_args)}
-    print(f'sql statement: {params["sql"]}')
+
+    client = CkanClient(url, headers, pool_size=max(workers, 10), cache=cache)
+    with client:
+        # Bepaal de kolommen van "full" één keer, niet per shard.
+        if kwargs.get("columns", "full") == "full":
+            kwargs["columns"] = full_columns(client, datastore, resource_id)
+        counts = count_records(
+            client,
+            start_datum,
+            stop_datum,
+            shard_unit,
+            resource_id=resource_id,
+            datastore=datastore,
+            sql_conditions=sql_conditions,
+        )
+        shards = _shard_bounds(counts, start_datum, stop_datum, limit)
+        print(f"Split {start_datum} - {stop_datum} in {len(shards)} shards.")
+
+        def fetch_shard(shard):
+            start, stop = shard
+            records = []
+            chunks = query_chunks(
+                api_key,
+                start,
+                stop,
+                pagination="keyset",
+                client=client,
+                include_start=start != start_datum,
+                **query_args,
+                **kwargs,
+            )
+            for chunk in chunks:
+                records += chunk
+            return records
+
+        records = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for shard_records in executor.map(fetch_shard, shards):
+                records += shard_records
+
+    df = records_to_frame(records)
+
+    print(f"Read {df.shape[0]} measurements in {time.time() - start_time} s.")
+    print(f"\n")
+
+    return df
+
+
+def count_records(
+    client,
+    start_datum,
+    stop_datum,
+    unit="hour",
+    resource_id="4cfb5177-d3db-4efc-ac6f-351af75f9f92",
+    datastore="provincie_utrecht_snuffelfiets_measurement_rydruofi",
+    sql_conditions=[],
+):
+    """Tel het aantal records per uur (of dag) in een datumbereik.
+
+    Returns a Series with the count per unit, indexed by timestamp.
+    """
+
+    sql = build_sql_statement(
+        columns=f"date_trunc('{unit}', \"recording_timestamp\") AS t, COUNT(*) AS n",
+        datastore=datastore,
+        conditions=sql_conditions + _date_conditions(start_datum, stop_datum),
+        parameters={"group by": "t", "order by": "t"},
+    )
+    records = client.get_chunk({"resource_id": resource_id, "sql": sql})
+
+    index = pd.to_datetime([record["t"] for record in records], format="ISO8601")
+    return pd.Series([int(record["n"]) for record in records], index=index)
+
+
+def _shard_bounds(counts, start_datum, stop_datum, limit=32000):
+    """Pack consecutive counts into shards of at most limit records.
+
+    Returns a list of (start, stop) tuples that together cover the range.
+    """
+
+    bounds = [start_datum]
+    n_shard = 0
+    for t, n in counts.items():
+        if n_shard and n_shard + n > limit:
+            bounds.append(t.strftime("%Y-%m-%dT%H:%M:%S"))
+            n_shard = 0
+        n_shard += n
+    bounds.append(stop_datum)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def call_api_checkpointed(
+    api_key, start_datum, stop_datum, checkpoint_directory, **kwargs
+):
+    """Doe een query per dag, met een checkpoint na elke dag.
+
+    De vensters lopen van middernacht tot middernacht; een start of stop met
+    tijd begrenst het eerste of laatste venster. Elke dag wordt na het
+    downloaden als Parquet bestand in checkpoint_directory geschreven en het
+    aantal rijen wordt bijgehouden in checkpoints.json. Een herstarte
+    download slaat de dagen over waarvan het bestand bestaat en het aantal
+    rijen klopt. Gebruik een aparte checkpoint_directory per query.
+    Zie query_chunks voor de keyword arguments.
+    """
 
     start_time = time.time()
 
-    records = get_records(url, headers, params, sql_parameters["limit"])
+    checkpoint_directory = Path(checkpoint_directory)
+    Path.mkdir(checkpoint_directory, parents=True, exist_ok=True)
+    p_state = Path(checkpoint_directory, CHECKPOINT_FILENAME)
+    state = _read_state(p_state)
 
-    df = pd.DataFrame(records)
-    df = drop_columns(df)
-    df = convert_to_int(df)
+    bounds = _day_bounds(start_datum, stop_datum)
+    dfs = []
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        name = f"{start}_{stop}".replace(":", "-")
+        p = Path(checkpoint_directory, f"{name}.parquet")
+        if _checkpoint_done(p, state.get(name)):
+            print(f"Checkpoint {name} found, skipping download.")
+            df = pd.read_parquet(p)
+        else:
+            # Bepaal de kolommen van "full" één keer, niet per dag.
+            if kwargs.get("columns", "full") == "full":
+                kwargs["columns"] = _query_full_columns(api_key, **kwargs)
+            df = call_api(api_key, start, stop, include_start=i > 0, **kwargs)
+            p_tmp = p.with_suffix(".tmp")
+            df.to_parquet(p_tmp, index=False)
+            p_tmp.replace(p)
+            state[name] = df.shape[0]
+            _write_state(p_state, state)
+        dfs.append(df)
+
+    df = pd.concat(dfs, ignore_index=True)
 
     print(f"Read {df.shape[0]} measurements in {time.time() - start_time} s.")
     print(f"\n")
@@ -137,6 +775,280 @@ def call_api(
     return df
 
 
+def _day_bounds(start_datum, stop_datum):
+    """Geef start_datum, elke middernacht ertussen en stop_datum.
+
+    Een start of stop met tijd (jjjj-mm-ddTuu:mm:ss) blijft behouden, zodat de
+    vensters samen precies het bereik van call_api beslaan.
+    """
+
+    _date_conditions(start_datum, stop_datum)  # controleert de notatie
+    start, stop = pd.Timestamp(start_datum), pd.Timestamp(stop_datum)
+    if start >= stop:
+        raise ValueError(f"Start {start_datum} ligt niet voor stop {stop_datum}.")
+
+    midnights = pd.date_range(
+        start.normalize() + pd.Timedelta(days=1), stop, freq="D", inclusive="left"
+    )
+    return [start_datum, *midnights.strftime("%Y-%m-%d"), stop_datum]
+
+
+def _checkpoint_done(p, n_rows):
+    """Check that a checkpoint file exists and has the expected row count."""
+
+    if n_rows is None or not p.exists():
+        return False
+
+    return pq.ParquetFile(p).metadata.num_rows == n_rows
+
+
+def stream_api(api_key, start_datum, stop_datum, path, **kwargs):
+    """Schrijf een query chunk voor chunk naar een CSV of Parquet bestand.
+
+    Elke chunk wordt omgezet naar een DataFrame, gecorrigeerd met
+    opschonen.correct_units en aan het bestand toegevoegd zodra hij binnen
+    is, zodat er nooit meer dan één chunk (of workers chunks) in het
+    geheugen is. Het formaat volgt uit de extensie van path; in Parquet
+    zijn de integer kolommen int64.
+    Zie query_chunks voor de keyword arguments.
+    """
+
+    start_time = time.time()
+
+    chunks = query_chunks(api_key, start_datum, stop_datum, **kwargs)
+    n_rows, _ = _write_chunks(chunks, path)
+
+    print(f"Wrote {n_rows} measurements to {path} in {time.time() - start_time} s.")
+    print(f"\n")
+
+    return n_rows
+
+
+def sync_csv(api_key, start_datum, stop_datum, path, **kwargs):
+    """Vul een CSV aan met de records na de high-water mark.
+
+    De laatst gelezen (recording_timestamp, _id) per bestand staat in
+    sync_state.json in dezelfde map. Zonder state wordt de high-water mark
+    uit een bestaande CSV gehaald, of wordt de hele periode gedownload.
+    Nieuwe records worden met keyset paginering opgehaald en aan de CSV
+    toegevoegd.
+
+    NB. records die later binnenkomen met een recording_timestamp van voor
+    de high-water mark worden zo niet opgehaald; draai daarvoor een
+    volledige download.
+    Zie query_chunks voor de keyword arguments.
+    """
+
+    start_time = time.time()
+
+    path = Path(path)
+    state = _read_state(path.parent / SYNC_STATE_FILENAME)
+    after = state.get(path.name)
+    if after is None and path.exists():
+        df = pd.read_csv(path, usecols=KEYSET_COLUMNS)
+        df["recording_timestamp"] = pd.to_datetime(
+            df["recording_timestamp"], format="ISO8601"
+        )
+        last = df.sort_values(KEYSET_COLUMNS).iloc[-1]
+        after = [last["recording_timestamp"].isoformat(), int(last["_id"])]
+    print(f"Syncing {path} after {after}")
+
+    def save_high_water_mark(last):
+        # Na elke toegevoegde chunk, zodat een afgebroken sync bij een
+        # herstart geen records dubbel toevoegt.
+        state[path.name] = [last[col] for col in KEYSET_COLUMNS]
+        _write_state(path.parent / SYNC_STATE_FILENAME, state)
+
+    chunks = query_chunks(
+        api_key, start_datum, stop_datum, pagination="keyset", after=after, **kwargs
+    )
+    n_rows, _ = _write_chunks(chunks, path, append=True, on_chunk=save_high_water_mark)
+
+    print(f"Added {n_rows} measurements to {path} in {time.time() - start_time} s.")
+    print(f"\n")
+
+    return n_rows
+
+
+def _read_state(p):
+    """Read a JSON state file (high-water marks, checkpoints)."""
+
+    if not Path(p).exists():
+        return {}
+
+    with open(p) as f:
+        return json.load(f)
+
+
+def _write_state(p, state):
+    """Write a JSON state file (high-water marks, checkpoints)."""
+
+    with open(p, "w") as f:
+        json.dump(state, f, indent=2, default=str)
+
+
+def _write_chunks(chunks, path, append=False, on_chunk=None):
+    """Convert, correct and write chunks to a file.
+
+    on_chunk is called with the last record of each chunk, after the chunk
+    has been written. Returns the number of rows written and the last record.
+    """
+
+    path = Path(path)
+    header = not (append and path.exists() and path.stat().st_size > 0)
+    mode = "a" if append else "w"
+    writer = None
+    n_rows = 0
+    last = None
+
+    if append and path.suffix == ".parquet":
+        raise ValueError(f"Cannot append to Parquet file {path}.")
+
+    for chunk in chunks:
+        df = records_to_frame(chunk)
+        df = opschonen.correct_units(df)
+        if path.suffix == ".parquet":
+            writer = _write_parquet_chunk(df, path, writer)
+        else:
+            df.to_csv(path, mode=mode, header=header, index=False)
+            mode, header = "a", False
+        n_rows += df.shape[0]
+        last = chunk[-1]
+        if on_chunk is not None:
+            on_chunk(last)
+
+    if writer is not None:
+        writer.close()
+
+    return n_rows, last
+
+
+def _write_parquet_chunk(df, path, writer=None):
+    """Append a chunk to a Parquet file, opening the writer on the first chunk.
+
+    Integer columns are written as int64: a later chunk can have values
+    that do not fit the type of the first chunk (see _typed_array).
+    """
+
+    if writer is None:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            if pa.types.is_integer(field.type):
+                schema = schema.set(i, field.with_type(pa.int64()))
+        writer = pq.ParquetWriter(path, schema)
+    table = pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+    writer.write_table(table)
+
+    return writer
+
+
+def full_columns(
+    client,
+    datastore="provincie_utrecht_snuffelfiets_measurement_rydruofi",
+    resource_id="4cfb5177-d3db-4efc-ac6f-351af75f9f92",
+):
+    """Geef alle kolommen van de datastore behalve _full_text (preset "full").
+
+    De kolommen worden uit één record gehaald. Kolommen die niet in
+    MEASUREMENT_SCHEMA staan blijven behouden en worden gemeld; zonder
+    records zijn het de kolommen van MEASUREMENT_SCHEMA.
+    """
+
+    sql = build_sql_statement(datastore=datastore, parameters={"limit": 1})
+    records = client.get_chunk({"resource_id": resource_id, "sql": sql})
+    if not records:
+        return COLUMN_PRESETS["full"]
+
+    columns = [col for col in records[0] if col != "_full_text"]
+    extra = [col for col in columns if col not in MEASUREMENT_SCHEMA]
+    if extra:
+        print(f"Columns {extra} are not in MEASUREMENT_SCHEMA, types are inferred.")
+
+    return columns
+
+
+def _query_full_columns(
+    api_key,
+    client=None,
+    url=API_URL,
+    datastore="provincie_utrecht_snuffelfiets_measurement_rydruofi",
+    resource_id="4cfb5177-d3db-4efc-ac6f-351af75f9f92",
+    cache=None,
+    **kwargs,
+):
+    """full_columns for the keyword arguments of query_chunks."""
+
+    if client is not None:
+        return full_columns(client, datastore, resource_id)
+
+    with CkanClient(url, {"X-CKAN-API-Key": api_key}, cache=cache) as client:
+        return full_columns(client, datastore, resource_id)
+
+
+def _select_columns(columns):
+    """Resolve a column preset or list of columns to a SELECT expression."""
+
+    if isinstance(columns, str) and columns in COLUMN_PRESETS:
+        columns = COLUMN_PRESETS[columns]
+
+    if isinstance(columns, (list, tuple)):
+        columns = ", ".join(f'"{col}"' for col in columns)
+
+    return columns
+
+
+def records_to_frame(records, schema=MEASUREMENT_SCHEMA, drop=["_full_text"]):
+    """Zet een lijst records om naar een DataFrame.
+
+    Elke kolom wordt direct als array van het type uit schema opgebouwd;
+    kolommen die niet in schema staan krijgen het type dat pandas afleidt.
+    De kolommen in drop worden overgeslagen.
+    """
+
+    columns = [col for col in (records[0] if records else []) if col not in drop]
+    if not columns:
+        return pd.DataFrame()
+
+    # Transponeer de records in een keer naar kolommen (in C, via zip),
+    # in plaats van per kolom over alle records te lopen.
+    get = itemgetter(*columns)
+    rows = map(get, records) if len(columns) > 1 else ((get(r),) for r in records)
+
+    data = {}
+    for col, values in zip(columns, zip(*rows)):
+        data[col] = _typed_array(values, schema.get(col))
+
+    return pd.DataFrame(data, columns=columns)
+
+
+def _typed_array(values, dtype):
+    """Build an array of dtype from a sequence of JSON values.
+
+    Integers that do not fit dtype are kept as int64 and integer columns
+    with missing values become float64.
+    """
+
+    if dtype is None:
+        return list(values)
+
+    if dtype == "datetime64":
+        return pd.to_datetime(values, format="ISO8601")
+
+    if dtype.startswith("float"):
+        return np.asarray(values, dtype=dtype)
+
+    try:
+        array = np.asarray(values, dtype="int64")
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy()
+
+    info = np.iinfo(dtype)
+    if array.size and (array.min() < info.min or array.max() > info.max):
+        return array
+
+    return array.astype(dtype)
+
+
 def drop_columns(df, columns=["_full_text"]):
     """Drop superfluous columns.
 
@@ -165,27 +1077,92 @@ def convert_to_int(
 
 
 def monthly_csv_dump(
-    api_key, year, month, data_directory=".", prefix="api_gegevens", preproc=True
+    api_key,
+    year,
+    month,
+    data_directory=".",
+    prefix="api_gegevens",
+    preproc=True,
+    stream=False,
+    incremental=False,
+    fmt="csv",
+    checkpoint_directory=None,
+    cache=None,
 ):
-    """Save a month of data as CSV."""
+    """Save a month of data as CSV.
+
+    De opgeslagen gegevens zijn al gecorrigeerd met opschonen.correct_units;
+    roep correct_units niet nogmaals aan na het inlezen van de CSV (de
+    bescherming daartegen werkt niet voor CSV bestanden).
+
+    stream: schrijf de CSV chunk voor chunk (zie stream_api). Alleen met
+        preproc=False: de voorbewerking splitst in ritten en heeft daarvoor
+        de hele maand in het geheugen nodig.
+    incremental: haal alleen records op die nog niet in de CSV staan en
+        voeg die toe (zie sync_csv).
+    fmt: "csv" of "parquet"; "parquet" schrijft de maand als partitie van
+        de Parquet dataset in data_directory (zie opslag).
+    checkpoint_directory: download per dag met checkpoints in deze map, zodat
+        een afgebroken download hervat kan worden (zie call_api_checkpointed).
+        Niet samen met stream of incremental.
+    cache: een ResponseCache of een map waarin de antwoorden van de API
+        bewaard worden; een volgende download van dezelfde maand gebruikt
+        die (niet bij stream en incremental).
+    """
+
+    if fmt not in ["csv", "parquet"]:
+        raise ValueError(f"Unknown format {fmt!r}.")
+    if fmt == "parquet" and (stream or incremental):
+        raise ValueError("stream and incremental are only available for CSV.")
+    if stream and preproc:
+        raise ValueError("stream requires preproc=False, preproc reads the full month.")
+    if checkpoint_directory is not None and (stream or incremental):
+        msg = "checkpoint_directory cannot be used with stream or incremental."
+        raise ValueError(msg)
 
     start_datum = f"{year}-{month:02d}-01"
     stop_datum = f"{year+1}-01-01" if month == 12 else f"{year}-{month+1:02d}-01"
 
-    df = call_api(api_key, start_datum, stop_datum)
-    df = opschonen.correct_units(df)
-
     filename = f"{prefix}_{year}-{month:02d}.csv"
     p = Path(data_directory, filename)
-    df.to_csv(p, index=False)
+
+    if incremental:
+        sync_csv(api_key, start_datum, stop_datum, p)
+        if preproc:
+            df = pd.read_csv(p)
+    elif stream:
+        stream_api(api_key, start_datum, stop_datum, p)
+    else:
+        if checkpoint_directory is None:
+            df = call_api(api_key, start_datum, stop_datum, cache=cache)
+        else:
+            p_checkpoints = Path(checkpoint_directory, f"{prefix}_{year}-{month:02d}")
+            df = call_api_checkpointed(
+                api_key, start_datum, stop_datum, p_checkpoints, cache=cache
+            )
+        df = opschonen.correct_units(df)
+        if fmt == "parquet":
+            opslag.write_partition(df, data_directory, year, month, prefix)
+        else:
+            df.to_csv(p, index=False)
+
+    if fmt == "csv" and not incremental:
+        # Een volledige download maakt een eerdere high-water mark ongeldig.
+        p_state = Path(data_directory, SYNC_STATE_FILENAME)
+        state = _read_state(p_state)
+        if state.pop(filename, None) is not None:
+            _write_state(p_state, state)
 
     if preproc:
         df = analyse.MCU_preprocessing(df)
 
         prefix = "mcu_gegevens"
-        filename = f"{prefix}_{year}-{month:02d}.csv"
-        p = Path(data_directory, filename)
-        df.to_csv(p, index=False)
+        if fmt == "parquet":
+            opslag.write_partition(df, data_directory, year, month, prefix)
+        else:
+            filename = f"{prefix}_{year}-{month:02d}.csv"
+            p = Path(data_directory, filename)
+            df.to_csv(p, index=False)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@
 """
 
 import numpy as np
+import pandas as pd
 
 
 # sommige data moet worden aangepast:
@@ -78,62 +79,156 @@ ERROR_DESCRIPTIONS = {
     32768: ["Reserved", ""],
 }
 
+# Bitmasker van de kritieke errors, voor verwijder_errors(df, error_mask=...).
+CRITICAL_ERRORS = sum(
+    code for code, descr in ERROR_DESCRIPTIONS.items() if descr[1] == "Critical Error"
+)
 
-def correct_units(df, correcties=CORRECTIE_DEFAULTS):
-    """Converteer de ruwe data naar correcte units."""
+
+def correct_units(df, correcties=CORRECTIE_DEFAULTS, force=False):
+    """Converteer de ruwe data naar correcte units.
+
+    De kolommen worden in df aangepast. De gecorrigeerde kolommen worden
+    bijgehouden in df.attrs["correct_units"]; een kolom nogmaals corrigeren
+    geeft een ValueError, tenzij force=True.
+
+    NB. deze bescherming werkt alleen in het geheugen en in Parquet
+    bestanden (die df.attrs bewaren). Een CSV bewaart df.attrs niet: een
+    gecorrigeerde CSV (bv. van monthly_csv_dump of stream_api) die weer
+    wordt ingelezen, kan dus ongemerkt nogmaals gecorrigeerd worden.
+    """
+
+    gecorrigeerd = list(df.attrs.get("correct_units", []))
+    dubbel = [col for col in correcties if col in gecorrigeerd and col in df.columns]
+    if dubbel and not force:
+        msg = f"Columns {dubbel} have already been corrected,"
+        msg += " use force=True to correct them again."
+        raise ValueError(msg)
+
+    # Bereken elk conditie masker één keer, op de ongecorrigeerde data.
+    default = {"factor": 1.0, "offset": 0, "conditie": None}
+    masks = {}
+    for correctie in correcties.values():
+        conditie = {**default, **correctie}["conditie"]
+        key = _conditie_key(conditie)
+        if key not in masks and (conditie is None or conditie["col"] in df.columns):
+            masks[key] = _get_mask(df, conditie)
 
     for col, correctie in correcties.items():
 
+        # sla kolommen over die niet zijn opgehaald
+        if col not in df.columns:
+            print(f"Column {col:12} not in dataframe, not corrected")
+            continue
+
         # doe niets als item niet gespecificeerd
-        default = {"factor": 1.0, "offset": 0, "conditie": None}
         corr = {**default, **correctie}
 
+        key = _conditie_key(corr["conditie"])
+        if key not in masks:
+            print(f"Condition column {key[0]} not in dataframe, {col} not corrected")
+            continue
+
         print(f"Correcting column {col:12} using {correctie}")
 
-        mask = _get_mask(df, col, corr)
+        # Eén float kopie per kolom, die in place gecorrigeerd wordt.
+        values = df[col].to_numpy(dtype=np.float64, copy=True)
+        mask = masks[key]
+        if mask is None:
+            values *= corr["factor"]
+            values += corr["offset"]
+        else:
+            values[mask] = corr["offset"] + values[mask] * corr["factor"]
+        df[col] = values
+
+        gecorrigeerd.append(col)
 
-        df[col] = np.where(mask, corr["offset"] + df[col] * corr["factor"], df[col])
+    df.attrs["correct_units"] = gecorrigeerd
 
     return df
 
 
-def _get_mask(df, col, corr):
+def _conditie_key(conditie):
+    """Hashable key of a conditie, to share its mask between columns."""
+
+    if conditie is None:
+        return None
+
+    return conditie["col"], conditie["fun"], conditie["val"]
+
+
+def _get_mask(df, conditie):
     """Maak een conditie masker.
 
-    om te kiezen tussen geconverteerde en originele data.
+    om te kiezen tussen geconverteerde en originele data; None betekent
+    dat alle data geconverteerd wordt.
     """
 
-    mask = np.zeros_like(df[col], dtype="bool")
+    if conditie is None:
+        return None
 
-    if corr["conditie"] is not None:
+    fun_conditie = conditie["fun"]
+    col_conditie = conditie["col"]
+    val_conditie = conditie["val"]
 
-        fun_conditie = corr["conditie"]["fun"]
-        col_conditie = corr["conditie"]["col"]
-        val_conditie = corr["conditie"]["val"]
+    mask = fun_conditie(df[col_conditie].to_numpy(), val_conditie)
 
-        mask = fun_conditie(df[col_conditie], val_conditie)
-
-    return mask
+    return np.asarray(mask, dtype=bool)
 
 
 def analyse_errors(df):
     """Print a short error breakdown."""
 
-    error_codes = np.unique(df["error_code"])
+    df_errors = error_breakdown(df)
 
-    for error_code in error_codes:
+    for error_code, df_code in df_errors.groupby("error_code", sort=False):
 
-        N = len(df[df["error_code"] == error_code])
+        N = df_code["count"].iloc[0]
 
         print(f"code {error_code:10}: count {N:15}")
 
-        compound = split_error_code(error_code)
-
-        for ec in compound:
-            descr = ERROR_DESCRIPTIONS[ec]
+        for ec, descr, soort in df_code[["error_bit", "description", "type"]].values:
+            if ec == 0:
+                continue
             d = " "
-            print(f"{ec:15}: {d:22} type       : {descr[1]}")
-            print(f"{ec:15}: {d:22} description: {descr[0]}")
+            print(f"{ec:15}: {d:22} type       : {soort}")
+            print(f"{ec:15}: {d:22} description: {descr}")
+
+
+def error_breakdown(df, per="code"):
+    """Tel de error codes in een dataframe.
+
+    per="code": een rij per (samengestelde) error_code en error bit daarin,
+        met het aantal metingen met die error_code. Code 0 heeft error_bit 0.
+    per="bit": een rij per error bit, met het aantal metingen waarvan de
+        error_code dat bit bevat.
+    Met de description en het type uit ERROR_DESCRIPTIONS.
+    """
+
+    codes, counts = np.unique(
+        df["error_code"].to_numpy(dtype=np.int64), return_counts=True
+    )
+    bits = 1 << np.arange(16)
+    has_bit = (codes[:, None] & bits[None, :]) != 0
+
+    if per == "bit":
+        df_errors = pd.DataFrame({"error_bit": bits, "count": counts @ has_bit})
+    elif per == "code":
+        # Code 0 heeft geen bits, maar wel een eigen rij.
+        has_bit = np.column_stack([codes == 0, has_bit])
+        bits = np.concatenate([[0], bits])
+        i, j = np.nonzero(has_bit)
+        df_errors = pd.DataFrame(
+            {"error_code": codes[i], "count": counts[i], "error_bit": bits[j]}
+        )
+    else:
+        raise ValueError(f"Unknown per {per!r}.")
+
+    descr = df_errors["error_bit"].map(ERROR_DESCRIPTIONS)
+    df_errors["description"] = descr.str[0]
+    df_errors["type"] = descr.str[1]
+
+    return df_errors
 
 
 def split_error_code(error_code):
@@ -151,9 +246,13 @@ def split_error_code(error_code):
     return error_codes
 
 
-def verwijder_errors(df, error_codes=[], print_breakdown=False):
+def verwijder_errors(df, error_codes=[], print_breakdown=False, error_mask=None):
     """Verwijder metingen met specifieke error codes.
 
+    error_mask: verwijder in plaats daarvan alle metingen waarvan de
+        error_code een van de bits in dit masker bevat, bv. CRITICAL_ERRORS.
+        Samengestelde codes met een van deze bits worden dus ook verwijderd.
+
     https://ckan.dataplatform.nl/dataset/snuffelfiets-extra-informatie-snifferbike-additional-info
     ------------------------------------------------------------------
     Name                                        number  Note
@@ -179,16 +278,23 @@ def verwijder_errors(df, error_codes=[], print_breakdown=False):
     if print_breakdown:
         analyse_errors(df)
 
-    if error_codes == []:
-        error_codes = set(np.unique(df.error_code)) - set([0])
-
-    mask = np.zeros_like(df.error_code, dtype="bool")
-    for error_code in error_codes:
-        emask = df["error_code"] == error_code
+    if error_mask is not None:
+        codes = df["error_code"].to_numpy(dtype=np.int64)
+        mask = (codes & error_mask) != 0
         print(
-            f"Removing {np.sum(emask):15} measurements with error_code {error_code:15}"
+            f"Removing {np.sum(mask):15} measurements with error bits {error_mask:15}"
         )
-        mask |= emask
+    else:
+        if error_codes == []:
+            error_codes = set(np.unique(df.error_code)) - set([0])
+
+        mask = np.zeros_like(df.error_code, dtype="bool")
+        for error_code in error_codes:
+            emask = df["error_code"] == error_code
+            print(
+                f"Removing {np.sum(emask):15} measurements with error_code {error_code:15}"
+            )
+            mask |= emask
 
     df = df[~mask]
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+"""Python module voor de lokale opslag van Snuffelfiets data.
+
+De data wordt opgeslagen als Parquet dataset, gepartitioneerd op jaar en maand:
+    <data_directory>/<prefix>/year=<jjjj>/month=<m>/part-0.parquet
+
+Bij het inlezen worden kolommen en datumbereik aan de Parquet reader
+doorgegeven, zodat alleen de benodigde kolommen en maanden gelezen worden.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("year", pa.int32()), ("month", pa.int32())]),
+    flavor="hive",
+)
+
+TIMESTAMP_COLUMNS = ["recording_timestamp", "receive_timestamp"]
+
+
+def partition_directory(data_directory, year, month, prefix="api_gegevens"):
+    """Geef de map van de partitie van een maand."""
+
+    return Path(data_directory, prefix, f"year={year}", f"month={month}")
+
+
+def write_partition(df, data_directory, year, month, prefix="api_gegevens"):
+    """Schrijf een maand data naar de dataset.
+
+    Een bestaande partitie voor deze maand wordt overschreven.
+    """
+
+    p = partition_directory(data_directory, year, month, prefix)
+    Path.mkdir(p, parents=True, exist_ok=True)
+    for old in p.glob("*.parquet"):
+        old.unlink()
+
+    df = _typed(df.drop(columns=["year", "month"], errors="ignore"))
+    df.to_parquet(Path(p, "part-0.parquet"), index=False)
+
+    print(f"Wrote {df.shape[0]} measurements to {p}.")
+
+    return p
+
+
+def read_dataset(
+    data_directory,
+    prefix="api_gegevens",
+    columns=None,
+    years=None,
+    months=None,
+    start_datum=None,
+    stop_datum=None,
+):
+    """Lees (een deel van) de dataset.
+
+    columns: de kolommen om in te lezen; None leest alle kolommen.
+    years, months: lees alleen deze jaren en maanden.
+    start_datum, stop_datum: lees alleen metingen in [start_datum, stop_datum).
+    """
+
+    dataset = ds.dataset(
+        Path(data_directory, prefix), format="parquet", partitioning=PARTITIONING
+    )
+
+    expr = None
+    if years is not None:
+        expr = _and(expr, ds.field("year").isin(list(years)))
+    if months is not None:
+        expr = _and(expr, ds.field("month").isin(list(months)))
+    if start_datum is not None or stop_datum is not None:
+        expr = _and(expr, _date_range_filter(start_datum, stop_datum))
+
+    table = dataset.to_table(columns=columns, filter=expr)
+    df = table.to_pandas()
+
+    print(f"Read {df.shape[0]} measurements from {Path(data_directory, prefix)}.")
+
+    return df
+
+
+def _date_range_filter(start_datum=None, stop_datum=None):
+    """Filter on the partitions and recording_timestamp of a date range."""
+
+    start = pd.Timestamp(start_datum) if start_datum is not None else None
+    stop = pd.Timestamp(stop_datum) if stop_datum is not None else None
+
+    # Selecteer ook de partities in het bereik, zodat de rest niet
+    # gelezen wordt.
+    expr = None
+    if start is not None and stop is not None:
+        last = stop - pd.Timedelta(1, "us")
+        periods = pd.period_range(start.to_period("M"), last.to_period("M"))
+        for period in periods:
+            month = (ds.field("year") == period.year) & (
+                ds.field("month") == period.month
+            )
+            expr = month if expr is None else expr | month
+
+    ts = ds.field("recording_timestamp")
+    if start is not None:
+        expr = _and(expr, ts >= pa.scalar(start, type=pa.timestamp("us")))
+    if stop is not None:
+        expr = _and(expr, ts < pa.scalar(stop, type=pa.timestamp("us")))
+
+    return expr
+
+
+def _and(expr, other):
+    """Combine two filter expressions, either of which may be None."""
+
+    if expr is None:
+        return other
+    if other is None:
+        return expr
+    return expr & other
+
+
+def _typed(df):
+    """Convert the timestamp columns to datetime64."""
+
+    for col in TIMESTAMP_COLUMNS:
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], format="ISO8601")
+
+    return df
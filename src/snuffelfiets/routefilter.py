@@ -1,18 +1,20 @@
 # Imports
 import pandas as pd
 import numpy as np
-import warnings
 from os import listdir
 from os.path import isfile, join
 from pathlib import Path
 from datetime import datetime
 
+from snuffelfiets import opslag
 from snuffelfiets.analyse import verdeel_in_ritten, bewerk_timestamp
 
 latMeter = 0.0000089988659514815  # 1 meter expressed in latitude (works for area province Utrecht)
 lonMeter = 0.0000146436902975532  # 1 meter expressed in longitude (works for area province Utrecht)
 latMin = 0  # 51.858631                   # smallest latitude province Utrecht
 lonMin = 0  # 4.794457                    # smallest longitude province Utrecht
+# The constants above are no longer used for xLon/yLat, see project_enu
+origin_default = (52.090695, 5.121314)  # (lat, lon) of the xLon/yLat origin, Utrecht
 main_directory_default = Path(
     Path("~").expanduser(), "Documents", "MCUdataclub", "RouteFilter"
 )
@@ -27,7 +29,19 @@ def read_data(
     years=None,
     months=None,
     prefix="mcu_gegevens",
+    fmt="csv",
+    columns=None,
+    origin=origin_default,
 ):
+    """Read Snuffelfiets measurements for the chosen years and months.
+
+    Kwargs:
+        fmt: "csv" reads the monthly CSV files, "parquet" reads the Parquet
+            dataset in data_directory (see opslag).
+        columns: List of columns to read; None reads all columns.
+        origin: (lat, lon) of the origin of the metric coordinates xLon and
+            yLat, see project_enu. Stored in df.attrs["xy_origin"].
+    """
     if not years:
         years = [2024]
 
@@ -39,15 +53,22 @@ def read_data(
 
     # Import data files for choosen range from data_directory
     df_list = []
-    for year in years:
-        for month in months:
-            filename = f"{prefix}_{year}-{month:02d}.csv"
-            p = Path(data_directory, filename)
-            try:
-                df = pd.read_csv(p)
-                df_list.append(df)
-            except:
-                print(f'[datafile] "{filename}" not found in {data_directory}\n')
+    if fmt == "parquet":
+        df = opslag.read_dataset(
+            data_directory, prefix, columns=columns, years=years, months=months
+        )
+        if df.shape[0]:
+            df_list.append(df)
+    else:
+        for year in years:
+            for month in months:
+                filename = f"{prefix}_{year}-{month:02d}.csv"
+                p = Path(data_directory, filename)
+                try:
+                    df = pd.read_csv(p, usecols=columns)
+                    df_list.append(df)
+                except:
+                    print(f'[datafile] "{filename}" not found in {data_directory}\n')
     try:
         df = pd.concat(df_list, ignore_index=True)
     except:
@@ -59,9 +80,9 @@ def read_data(
         df = verdeel_in_ritten(df)
     if any(col not in df.columns for col in ["year", "month"]):
         df = bewerk_timestamp(df, split=True)
-    # add columns yLat and xLon to df
-    df["yLat"] = (df["latitude"] - latMin) / latMeter
-    df["xLon"] = (df["longitude"] - lonMin) / lonMeter
+    # add columns yLat and xLon (meters) to df
+    df["xLon"], df["yLat"] = project_enu(df["latitude"], df["longitude"], origin)
+    df.attrs["xy_origin"] = tuple(origin)
 
     # add column unique_rit_id
     df["unique_rit_id"] = df["rit_id"] + df["year"] * 1000000 + df["month"] * 10000
@@ -73,6 +94,44 @@ def read_data(
     return df
 
 
+def project_enu(lat, lon, origin=origin_default):
+    """Project lat/lon (degrees, WGS84) on the tangent plane at origin.
+
+    Returns the float64 arrays x (east) and y (north) in meters, computed
+    via earth-centered (ECEF) coordinates. Within 100 km of origin
+    distances are accurate to 0.03%; elsewhere use an origin near the data.
+    """
+
+    a = 6378137.0  # WGS84 semi-major axis
+    f = 1 / 298.257223563  # WGS84 flattening
+    e2 = f * (2 - f)
+
+    def ecef(phi, lam):
+        N = a / np.sqrt(1 - e2 * np.sin(phi) ** 2)
+        return (
+            N * np.cos(phi) * np.cos(lam),
+            N * np.cos(phi) * np.sin(lam),
+            N * (1 - e2) * np.sin(phi),
+        )
+
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    lam = np.radians(np.asarray(lon, dtype=np.float64))
+    phi0, lam0 = np.radians(origin[0]), np.radians(origin[1])
+
+    X, Y, Z = ecef(phi, lam)
+    X0, Y0, Z0 = ecef(phi0, lam0)
+    dX, dY, dZ = X - X0, Y - Y0, Z - Z0
+
+    x = -np.sin(lam0) * dX + np.cos(lam0) * dY
+    y = (
+        -np.sin(phi0) * np.cos(lam0) * dX
+        - np.sin(phi0) * np.sin(lam0) * dY
+        + np.cos(phi0) * dZ
+    )
+
+    return x, y
+
+
 def read_routes(
     routes_directory=routes_directory_default,
     years=None,
@@ -144,144 +203,348 @@ def filter_routes(
     output_directory=output_directory_default,
     distance=10,
     isExtend=True,
+    cell_size=50,
+    block_size=8192,
 ):
+    """Filter the measurements within distance of each route.
+
+    Writes per route the matched measurements (see materialize) and the
+    route segments to csv files in output_directory. df and the routes in
+    dfR_list are not changed.
+
+    Returns the matches per route, see match_routes.
+    """
     if not output_directory.exists():
         Path.mkdir(output_directory, parents=True, exist_ok=True)
 
     # Parameters
     timestamp = str(int(datetime.timestamp(datetime.now())))
 
-    # Lists for dataframes
-    df_list = []  # List for csv imports
-    dfS_list = []  # List for dfS (measurements per segment)
-    dfO_list = []  # List for dfO (output dataframes per route)
-
-    # Ignore expected error
-    warnings.filterwarnings("ignore", message="invalid value encountered in arc")
-
-    # use route points to filter df to max/min lat/lon
-    maxLat = 0
-    minLat = 999
-    maxLon = 0
-    minLon = 999
-
-    for dfR in dfR_list:
-        maxLatRoute = max(dfR["latitude"])
-        minLatRoute = min(dfR["latitude"])
-        maxLonRoute = max(dfR["longitude"])
-        minLonRoute = min(dfR["longitude"])
-        maxLat = max(maxLatRoute, maxLat) + (distance * latMeter)
-        minLat = min(minLatRoute, minLat) - (distance * latMeter)
-        maxLon = max(maxLonRoute, maxLon) + (distance * lonMeter)
-        minLon = min(minLonRoute, minLon) - (distance * lonMeter)
-
-    df = df[df["latitude"].between(minLat, maxLat)]
-    df = df[df["longitude"].between(minLon, maxLon)]
-
-    print(f"{df.shape[0]} filtered measurements remaining\n")
+    # Transform the routes into segments per row, in the coordinates of df
+    origin = df.attrs.get("xy_origin", origin_default)
+    dfS_list = []
+    for idx, dfR in enumerate(dfR_list):
+        dfS = _route_segments(dfR, distance, isExtend, origin)
+        print(f"created {dfS.shape[0]} segments from {routes[idx]}...")
+        dfS_list.append(dfS)
+
+    # Match the measurements to all routes in one pass
+    matches = _match_routes(df, dfS_list, distance, cell_size, block_size)
+
     print(f"writing output to {output_directory}\n")
 
-    # LOOP THROUGH ROUTES
-    for idx, dfR in enumerate(dfR_list):
+    # Materialize the full rows one route at a time
+    for idx, dfS in enumerate(dfS_list):
+        dfO = materialize(df, matches[idx], dfS)
+        output_filtered(
+            idx, dfO, dfS, timestamp, routes, output_directory=output_directory
+        )
+
+    return matches
+
+
+def match_routes(
+    dfR_list, df, distance=10, isExtend=True, cell_size=50, block_size=8192
+):
+    """Find the measurements within distance of each route.
+
+    A measurement is assigned to the first segment of the route that it
+    lies next to (within distance of the segment line, between its begin
+    and end point). Instead of testing every measurement against every
+    segment, the segment bounding boxes (buffered by distance) of all
+    routes are put in one uniform grid of cell_size meters, and each
+    measurement is only tested against the segments in its grid cell, with
+    the dot products of project_on_segments. The measurements are
+    processed in tiles of block_size. df needs the metric coordinates
+    xLon and yLat of read_data; the routes are projected on the same plane.
+
+    Returns per route a compact dataframe, ordered by segment and then by
+    the order in df, with columns:
+        row: position of the measurement in df (for df.iloc).
+        routeSegment: segment number (index of its begin point + 1).
+        M-BE: distance (m) from the measurement to the segment.
+        distRoute: distance (m) along the route.
+    Use materialize for the full rows.
+    """
+
+    origin = df.attrs.get("xy_origin", origin_default)
+    dfS_list = [_route_segments(dfR, distance, isExtend, origin) for dfR in dfR_list]
+
+    return _match_routes(df, dfS_list, distance, cell_size, block_size)
+
+
+def materialize(df, match, dfS=None):
+    """Select the full rows of the matches of a route from df.
+
+    The rows get the columns routeSegment, M-BE and distRoute of match.
+    With dfS, the segments of the route, also the columns MB, ME, aMB, aME
+    and distSegment (the output columns of filter_routes).
+    """
+
+    rows = match["row"].to_numpy()
+    dfO = df.iloc[rows].reset_index(drop=True)
+    dfO["routeSegment"] = match["routeSegment"].to_numpy()
+    if dfS is not None:
+        dfS = dfS.loc[dfO["routeSegment"] - 1]
+        x = df["xLon"].to_numpy(dtype=np.float64)[rows]
+        y = df["yLat"].to_numpy(dtype=np.float64)[rows]
+        for col, values in _triangle(x, y, dfS).items():
+            dfO[col] = values
+    dfO["M-BE"] = match["M-BE"].to_numpy()
+    if dfS is not None:
+        distBegin = dfS["distBegin"].to_numpy()
+        dfO["distSegment"] = match["distRoute"].to_numpy() - distBegin
+    dfO["distRoute"] = match["distRoute"].to_numpy()
+
+    return dfO
+
+
+def _triangle(x, y, dfS):
+    """Sides MB, ME and angles aMB (at E), aME (at B) of measurements M.
+
+    dfS has the segment of each measurement.
+    """
+
+    xB, yB, xE, yE = [dfS[col].to_numpy() for col in ["xB", "yB", "xE", "yE"]]
+    dxB, dyB = x - xB, y - yB
+    dxE, dyE = x - xE, y - yE
+    ex, ey = xE - xB, yE - yB
+    cross = np.abs(dxB * ey - dyB * ex)
 
-        # Reset dfS_list and routeSegment for this route
-        dfS_list = []
-        df["routeSegment"] = 0
-
-        # Add columns to dfR and transform dfR into segments per row
-        dfR["longitude2"] = dfR["longitude"].shift(-1)
-        dfR["latitude2"] = dfR["latitude"].shift(-1)
-        dfR.drop(dfR.tail(1).index, inplace=True)
-        dfR["xB"] = (dfR["longitude"] - lonMin) / lonMeter
-        dfR["yB"] = (dfR["latitude"] - latMin) / latMeter
-        dfR["xE"] = (dfR["longitude2"] - lonMin) / lonMeter
-        dfR["yE"] = (dfR["latitude2"] - latMin) / latMeter
-        print(f"created {dfR.shape[0]} segments from {routes[idx]}...")
-
-        # Calculate segment length
+    return {
+        "MB": np.hypot(dxB, dyB),
+        "ME": np.hypot(dxE, dyE),
+        "aMB": np.arctan2(cross, -(dxE * ex + dyE * ey)),
+        "aME": np.arctan2(cross, dxB * ex + dyB * ey),
+    }
+
+
+def _route_segments(dfR, distance=10, isExtend=True, origin=origin_default):
+    """Segments of route dfR, with one segment per row.
+
+    B is the begin point and E the end point of a segment, in meters from
+    origin (see project_enu). Returns a copy, dfR is not changed.
+    """
+
+    dfR = dfR.copy()
+
+    # Add columns to dfR and transform dfR into segments per row
+    dfR["longitude2"] = dfR["longitude"].shift(-1)
+    dfR["latitude2"] = dfR["latitude"].shift(-1)
+    dfR.drop(dfR.tail(1).index, inplace=True)
+    dfR["xB"], dfR["yB"] = project_enu(dfR["latitude"], dfR["longitude"], origin)
+    dfR["xE"], dfR["yE"] = project_enu(dfR["latitude2"], dfR["longitude2"], origin)
+
+    # Calculate segment length
+    dfR["BE"] = np.sqrt(
+        np.square(dfR["xE"] - dfR["xB"]) + np.square(dfR["yE"] - dfR["yB"])
+    )
+    dfR["distBegin"] = dfR["BE"].cumsum().shift(1).fillna(0)
+
+    # Extend segment from end point E with set distance
+    # TODO: don't extend last segment somehow
+    if isExtend:
+        dfR["xE"] = (dfR["xE"] - dfR["xB"]) * (distance / dfR["BE"]) + dfR["xE"]
+        dfR["yE"] = (dfR["yE"] - dfR["yB"]) * (distance / dfR["BE"]) + dfR["yE"]
         dfR["BE"] = np.sqrt(
             np.square(dfR["xE"] - dfR["xB"]) + np.square(dfR["yE"] - dfR["yB"])
         )
-        dfR["distBegin"] = dfR["BE"].cumsum().shift(1).fillna(0)
-
-        # Extend segment from end point E with set distance
-        # TODO: don't extend last segment somehow
-        if isExtend:
-            dfR["xE"] = (dfR["xE"] - dfR["xB"]) * (distance / dfR["BE"]) + dfR["xE"]
-            dfR["yE"] = (dfR["yE"] - dfR["yB"]) * (distance / dfR["BE"]) + dfR["yE"]
-            dfR["BE"] = np.sqrt(
-                np.square(dfR["xE"] - dfR["xB"]) + np.square(dfR["yE"] - dfR["yB"])
-            )
 
-        # LOOP THROUGH SEGMENTS OF ROUTE
-        for index, segment in dfR.iterrows():
+    return dfR
 
-            # Calculate sides MB, ME using Pythagorean theorem
-            df["MB"] = np.sqrt(
-                np.square(df["xLon"] - segment["xB"])
-                + np.square(df["yLat"] - segment["yB"])
-            )
-            df["ME"] = np.sqrt(
-                np.square(df["xLon"] - segment["xE"])
-                + np.square(df["yLat"] - segment["yE"])
-            )
 
-            # Calculate angles aBE, aMB, aME using Law of cosines (aBE is currently redundant)
-            df["aMB"] = np.acos(
-                (np.square(df["ME"]) + np.square(segment["BE"]) - np.square(df["MB"]))
-                / (2 * segment["BE"] * df["ME"])
-            )
-            df["aME"] = np.acos(
-                (np.square(df["MB"]) + np.square(segment["BE"]) - np.square(df["ME"]))
-                / (2 * segment["BE"] * df["MB"])
-            )
-            # df['aBE'] = np.acos(
-            # ( np.square(df['MB']) + np.square(df['ME']) - np.square(segment['BE']) )
-            # / (2 * df['MB'] * df['ME']) )
-
-            # Calculate distances
-            df["M-BE"] = (
-                np.sin(df["aME"]) * df["MB"]
-            )  # distance from measurement perpendicular to route segment line BE
-            df["distSegment"] = (
-                np.cos(df["aME"]) * df["MB"]
-            )  # distance measurement along segment
-            df["distRoute"] = (
-                df["distSegment"] + segment["distBegin"]
-            )  # distance measurement along total route
-
-            # Filter and add routeSegment number
-            df.loc[
-                (df["M-BE"].between(0, distance))
-                & (df["aMB"].between(0, np.pi / 2))
-                & (df["aME"].between(0, np.pi / 2))
-                & (df["routeSegment"] == 0),
-                ["routeSegment"],
-            ] = (
-                index + 1
-            )
+def _match_routes(df, dfS_list, distance=10, cell_size=50, block_size=8192):
+    """Match the measurements in df to the segments of the routes.
 
-            # Save filtered measurements
-            dfS = df[df["routeSegment"] == index + 1]
-            # dfS['test2'] = 0 #why does this give a copywarning?
-            dfS_list.append(dfS)  # Append dfS to dfS_List
+    The segments of all routes share one grid, so the measurements are
+    matched to all routes in one pass. See match_routes.
+    """
 
-        # Concat all dfS of route into dfO in dfO_list
-        dfO_list.append(pd.concat(dfS_list, ignore_index=True))
+    x = df["xLon"].to_numpy(dtype=np.float64)
+    y = df["yLat"].to_numpy(dtype=np.float64)
 
-        output_filtered(
-            idx, dfO_list, dfR, timestamp, routes, output_directory=output_directory
+    # use the segments to filter df to max/min x/y
+    xS = np.concatenate([dfS[["xB", "xE"]].to_numpy().ravel() for dfS in dfS_list])
+    yS = np.concatenate([dfS[["yB", "yE"]].to_numpy().ravel() for dfS in dfS_list])
+    inside = (x >= xS.min() - distance) & (x <= xS.max() + distance)
+    inside &= (y >= yS.min() - distance) & (y <= yS.max() + distance)
+    positions = np.flatnonzero(inside)
+    x, y = x[positions], y[positions]
+
+    print(f"{len(positions)} filtered measurements remaining\n")
+
+    dfS = pd.concat(
+        [dfS[["xB", "yB", "xE", "yE", "BE"]] for dfS in dfS_list], ignore_index=True
+    )
+    xB, yB, xE, yE, BE = [dfS[col].to_numpy() for col in dfS.columns]
+    route = np.repeat(np.arange(len(dfS_list)), [len(dfS) for dfS in dfS_list])
+    first_segment = np.cumsum([0] + [len(dfS) for dfS in dfS_list])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ux, uy = (xE - xB) / BE, (yE - yB) / BE
+    grid = _segment_grid(xB, yB, xE, yE, distance, cell_size)
+
+    # Work in tiles of block_size points, so the candidate pairs of a tile
+    # stay small enough for the CPU cache.
+    results = [[] for _ in dfS_list]
+    for start in range(0, len(x), block_size):
+        points, segments = _grid_candidates(
+            grid, x[start : start + block_size], y[start : start + block_size]
+        )
+        points += start
+
+        M_BE, distSegment = project_on_segments(
+            x[points],
+            y[points],
+            xB[segments],
+            yB[segments],
+            ux[segments],
+            uy[segments],
+        )
+        match = (distSegment >= 0) & (distSegment <= BE[segments]) & (M_BE <= distance)
+
+        # The candidates are ordered by point and then by segment (and so by
+        # route), so the first match of a point and route is its first
+        # segment of that route.
+        points, segments = points[match], segments[match]
+        first = np.ones(len(points), dtype=bool)
+        first[1:] = (points[1:] != points[:-1]) | (
+            route[segments[1:]] != route[segments[:-1]]
         )
+        points, segments = points[first], segments[first]
+        M_BE, distSegment = M_BE[match][first], distSegment[match][first]
+
+        for idx in range(len(dfS_list)):
+            in_route = route[segments] == idx
+            results[idx].append(
+                [
+                    points[in_route],
+                    segments[in_route] - first_segment[idx],
+                    M_BE[in_route],
+                    distSegment[in_route],
+                ]
+            )
+
+    empty = [np.zeros(0, dtype=np.int64)] * 2 + [np.zeros(0)] * 2
+    matches = []
+    for dfS, result in zip(dfS_list, results):
+        rows, segments, M_BE, distSegment = [
+            np.concatenate(arrays) for arrays in zip(empty, *result)
+        ]
+
+        # Order by segment, then by the order in df
+        order = np.lexsort((rows, segments))
+        rows, segments = rows[order], segments[order]
+        distBegin = dfS["distBegin"].to_numpy()[segments]
+        match = pd.DataFrame(
+            {
+                "row": positions[rows],
+                "routeSegment": dfS.index.to_numpy()[segments] + 1,
+                "M-BE": M_BE[order],
+                "distRoute": distSegment[order] + distBegin,
+            }
+        )
+        matches.append(match)
+
+    return matches
+
+
+def project_on_segments(x, y, xB, yB, ux, uy):
+    """Project points (x, y) on the lines through segments.
+
+    The segments start at (xB, yB) and have unit direction vectors (ux, uy).
+    The arrays broadcast, so this works for pairs of points and segments as
+    well as for a block of points (n, 1) against a block of segments (1, m).
+    Returns the perpendicular distance to the line and the (signed)
+    distance along the segment from the begin point.
+    """
+
+    dx = x - xB
+    dy = y - yB
+    along = dx * ux + dy * uy
+    perpendicular = np.abs(dx * uy - dy * ux)
+
+    return perpendicular, along
+
 
+def _segment_grid(xB, yB, xE, yE, distance=10, cell_size=50):
+    """Put the bounding boxes of the segments, buffered by distance, in a grid.
+
+    Returns a dict with the grid origin, cell size and shape, and the
+    sorted cell numbers with the segment of each entry.
+    """
+
+    xmin = np.minimum(xB, xE) - distance
+    xmax = np.maximum(xB, xE) + distance
+    ymin = np.minimum(yB, yE) - distance
+    ymax = np.maximum(yB, yE) + distance
+    valid = np.isfinite(xmin + xmax + ymin + ymax)
+    if not valid.any():
+        valid[:] = True
+        xmin = xmax = ymin = ymax = np.zeros(len(valid))
+
+    x0, y0 = xmin[valid].min(), ymin[valid].min()
+    nx = int((xmax[valid].max() - x0) // cell_size) + 1
+    ny = int((ymax[valid].max() - y0) // cell_size) + 1
+
+    segment = np.flatnonzero(valid)
+    ix0 = ((xmin[segment] - x0) // cell_size).astype(np.int64)
+    ix1 = ((xmax[segment] - x0) // cell_size).astype(np.int64)
+    iy0 = ((ymin[segment] - y0) // cell_size).astype(np.int64)
+    iy1 = ((ymax[segment] - y0) // cell_size).astype(np.int64)
+
+    # Expand every segment to the cells of its bounding box.
+    n_y = iy1 - iy0 + 1
+    n_cells = (ix1 - ix0 + 1) * n_y
+    entry = np.repeat(np.arange(len(segment)), n_cells)
+    offset = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    cells = (ix0[entry] + offset // n_y[entry]) * ny + iy0[entry] + offset % n_y[entry]
+
+    # Stable, so the segments of a cell stay in route order.
+    order = np.argsort(cells, kind="stable")
+
+    return {
+        "x0": x0,
+        "y0": y0,
+        "cell_size": cell_size,
+        "nx": nx,
+        "ny": ny,
+        "cells": cells[order],
+        "segments": segment[entry[order]],
+    }
+
+
+def _grid_candidates(grid, x, y):
+    """Pair each point with the segments in its grid cell.
+
+    Returns the positions of the points and segments of all pairs, ordered
+    by point and then by segment.
+    """
+
+    ix = np.floor((x - grid["x0"]) / grid["cell_size"])
+    iy = np.floor((y - grid["y0"]) / grid["cell_size"])
+    inside = (ix >= 0) & (ix < grid["nx"]) & (iy >= 0) & (iy < grid["ny"])
+    points = np.flatnonzero(inside)
+    cell = ix[points].astype(np.int64) * grid["ny"] + iy[points].astype(np.int64)
+
+    left = np.searchsorted(grid["cells"], cell, side="left")
+    right = np.searchsorted(grid["cells"], cell, side="right")
+    n = right - left
+    points = np.repeat(points, n)
+    entry = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(left, n)
+
+    return points, grid["segments"][entry]
+
+
+def output_filtered(idx, dfO, dfR, timestamp, routes, output_directory=None):
+    # dfO of route idx, or the list of dfO of all routes
+    if isinstance(dfO, list):
+        dfO = dfO[idx]
 
-def output_filtered(idx, dfO_list, dfR, timestamp, routes, output_directory=None):
     # export dfO
     filename2 = timestamp + "-dfOutput-" + routes[idx]
     p = Path(output_directory, filename2)
-    dfO_list[idx].to_csv(p, index=False)
-    print(
-        f"...exported {dfO_list[idx].shape[0]} filtered measurements to {filename2}\n"
-    )
+    dfO.to_csv(p, index=False)
+    print(f"...exported {dfO.shape[0]} filtered measurements to {filename2}\n")
 
     # export dfR for testing
     filename2 = timestamp + "-dfRoute-" + routes[idx]
@@ -0,0 +1,61 @@
+# Benchmarks decoding a CKAN response of one chunk (32000 records) into a
+# DataFrame: the old path (json.loads of response.text, a DataFrame of the
+# record dicts, then drop_columns and convert_to_int) against
+# inlezen.decode_json and inlezen.records_to_frame.
+#
+# Usage:
+#   python tests/bench_decode.py [n_records]
+import contextlib
+import io
+import json
+import sys
+import time
+
+import pandas as pd
+
+from ckan_server import STRING_COLUMNS, synthetic_measurements
+from snuffelfiets import inlezen
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 32000
+repeat = 5
+
+
+def payload(n):
+    records = synthetic_measurements(n).to_dict("records")
+    for record in records:
+        for col in STRING_COLUMNS:
+            record[col] = str(record[col])
+        record["_full_text"] = "fake data"
+    return json.dumps({"success": True, "result": {"records": records}}).encode()
+
+
+def old(content):
+    records = json.loads(content.decode())["result"]["records"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = pd.DataFrame(records)
+        df = inlezen.drop_columns(df)
+        df = inlezen.convert_to_int(df)
+    return df
+
+
+def new(content):
+    records = inlezen.decode_json(content)["result"]["records"]
+    return inlezen.records_to_frame(records)
+
+
+def best_of(f, content):
+    duur = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        f(content)
+        duur.append(time.perf_counter() - start_time)
+    return min(duur)
+
+
+if __name__ == "__main__":
+    content = payload(n_records)
+    decoder = "orjson" if inlezen.orjson is not None else "json"
+    print(f"{n_records} records, {len(content) / 1e6:.1f} MB, decoder: {decoder}")
+    for name, f in [("old", old), ("new", new)]:
+        duur = best_of(f, content)
+        print(f"{name}: {n_records / duur:12.0f} records/s ({duur * 1000:.0f} ms)")
@@ -0,0 +1,43 @@
+# Benchmarks chunk fetching in inlezen.get_records against the local CKAN
+# stand-in, so no network access (or API key) is needed.
+# The latency argument emulates the round trip time to the production API.
+# The server runs in a separate process, so it does not compete with the
+# client for the GIL.
+#
+# Usage:
+#   python tests/bench_get_records.py [n_records] [latency_s]
+import multiprocessing
+import sys
+import time
+
+from ckan_server import FakeCkanServer, synthetic_measurements
+from snuffelfiets import inlezen
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+limit = 32000
+
+
+def serve(queue, n_records, latency):
+    with FakeCkanServer(synthetic_measurements(n_records), latency=latency) as server:
+        queue.put(server.url)
+        queue.get()
+
+
+if __name__ == "__main__":
+    queue = multiprocessing.Manager().Queue()
+    process = multiprocessing.Process(target=serve, args=(queue, n_records, latency))
+    process.start()
+    url = queue.get()
+
+    sql = inlezen.build_sql_statement(parameters={"limit": limit})
+    for workers in [1, 2, 4, 8]:
+        params = {"resource_id": "", "sql": sql}
+        start_time = time.time()
+        records = inlezen.get_records(url, {}, params, limit=limit, workers=workers)
+        duur = time.time() - start_time
+        assert len(records) == n_records
+        print(f"workers={workers}: {n_records / duur:12.0f} records/s ({duur:.2f} s)")
+
+    queue.put("stop")
+    process.join()
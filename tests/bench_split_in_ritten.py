@@ -0,0 +1,37 @@
+# Benchmarks analyse.split_in_ritten against the per-entity loop it
+# replaced, on synthetic measurements of many devices.
+#
+# Usage:
+#   python tests/bench_split_in_ritten.py [n_records] [n_entities]
+import contextlib
+import io
+import sys
+import time
+
+import pandas as pd
+
+from ckan_server import synthetic_measurements
+from snuffelfiets import analyse
+from test_analyse import split_in_ritten_loop
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+n_entities = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+
+if __name__ == "__main__":
+    df = synthetic_measurements(n_records, n_entities=n_entities)
+    df["date_time"] = pd.to_datetime(df["recording_timestamp"])
+    df = analyse._sort(df)
+
+    results = {}
+    for name, f in [("loop", split_in_ritten_loop), ("new", analyse.split_in_ritten)]:
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = f(df.copy())
+        duur = time.perf_counter() - start_time
+        print(f"{name}: {duur:.2f} s ({n_records} records, {n_entities} entities)")
+
+    for col in ["duur", "afstand", "snelheid", "rit_id"]:
+        pd.testing.assert_series_equal(
+            results["new"][col], results["loop"][col], check_dtype=False
+        )
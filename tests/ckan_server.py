@@ -0,0 +1,178 @@
+# Local stand-in for the CKAN datastore_search_sql endpoint.
+#
+# The production database contains privacy-sensitive data, so the tests and
+# benchmarks for inlezen.py run against this server instead. It loads a
+# DataFrame into an in-memory sqlite database under the name of the CKAN
+# datastore and executes the SQL statements that inlezen.build_sql_statement
+# emits. Responses mimic CKAN: some integer columns come back as strings and
+# every record has a '_full_text' column. Failures can be injected with
+# fail_next to test retries.
+#
+# Usage:
+#   with FakeCkanServer(df, latency=0.05) as server:
+#       df = inlezen.call_api("", "2024-11-11", "2024-11-13", url=server.url)
+import json
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+DATASTORE = "provincie_utrecht_snuffelfiets_measurement_rydruofi"
+# Columns that CKAN returns as strings instead of ints
+STRING_COLUMNS = ["entity_id", "version_major", "version_minor", "error_code"]
+
+
+class FakeCkanServer:
+    """Serve a DataFrame through a CKAN-like datastore_search_sql API."""
+
+    def __init__(self, df, datastore=DATASTORE, latency=0.0, host="127.0.0.1"):
+        df = df.drop(columns=["Unnamed: 0"], errors="ignore")
+        df = df.assign(_full_text="fake data")
+        self.datastore = datastore
+        self.latency = latency
+        self.n_requests = 0
+        self.n_connections = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.db.create_function("date_trunc", 2, date_trunc)
+        df.to_sql(datastore, self.db, index=False)
+        self.httpd = ThreadingHTTPServer((host, 0), self._handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/3/action/datastore_search_sql"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.db.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def fail_next(self, n=1, status=503):
+        """Answer the next n requests with an error status."""
+        with self.lock:
+            self.failures += [status] * n
+
+    def insert(self, df):
+        """Add measurements, e.g. to emulate newly uploaded data."""
+        df = df.drop(columns=["Unnamed: 0"], errors="ignore")
+        df = df.assign(_full_text="fake data")
+        with self.lock:
+            df.to_sql(self.datastore, self.db, index=False, if_exists="append")
+
+    def query(self, sql):
+        """Run a statement and return CKAN style records."""
+        with self.lock:
+            self.n_requests += 1
+            cursor = self.db.execute(sql)
+            fields = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(fields, row))
+            for col in STRING_COLUMNS:
+                if col in record:
+                    record[col] = str(record[col])
+            records.append(record)
+        return records, fields
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so clients can reuse their connections
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.n_connections += 1
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                sql = query.get("sql", [""])[0]
+                time.sleep(server.latency)
+                with server.lock:
+                    status = server.failures.pop(0) if server.failures else None
+                if status is not None:
+                    body = {"success": False, "error": {"message": "fake failure"}}
+                    return self._send(status, body)
+                try:
+                    records, fields = server.query(sql)
+                except sqlite3.Error as e:
+                    body = {"success": False, "error": {"message": str(e)}}
+                    return self._send(409, body)
+                fields = [{"id": f} for f in fields]
+                body = {
+                    "success": True,
+                    "result": {"records": records, "fields": fields, "sql": sql},
+                }
+                self._send(200, body)
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def date_trunc(unit, timestamp):
+    """The PostgreSQL date_trunc function for ISO timestamp strings."""
+    length = {"day": 10, "hour": 13, "minute": 16}[unit]
+    return pd.Timestamp(timestamp[:length]).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def synthetic_measurements(n, start="2024-09-01", n_entities=50, seed=0):
+    """Generate n fake measurements in the CKAN column layout."""
+    rng = np.random.default_rng(seed)
+    timestamps = pd.Timestamp(start) + pd.to_timedelta(
+        np.sort(rng.integers(0, 28 * 24 * 3600, n)), unit="s"
+    )
+    return pd.DataFrame(
+        {
+            "_id": np.arange(1, n + 1),
+            "entity_id": 356726100000000 + rng.integers(0, n_entities, n),
+            "recording_timestamp": timestamps.strftime("%Y-%m-%dT%H:%M:%S"),
+            "receive_timestamp": timestamps.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+            "acc_max": rng.integers(0, 15, n),
+            "error_code": rng.choice([0, 0, 0, 32, 2048], n),
+            "horizontal_accuracy": rng.integers(0, 99999, n),
+            "humidity": rng.integers(40, 90, n),
+            "latitude": 52.09 + rng.normal(0, 0.02, n),
+            "longitude": 5.12 + rng.normal(0, 0.03, n),
+            "no2": np.zeros(n, dtype=int),
+            "pm10": rng.integers(0, 4000, n),
+            "pm1_0": rng.integers(0, 4000, n),
+            "pm2_5": rng.integers(0, 4000, n),
+            "pressure": rng.integers(980, 1040, n),
+            "temperature": rng.integers(100, 250, n),
+            "version_major": rng.choice([1, 2], n),
+            "version_minor": rng.integers(3, 9, n),
+            "vertical_accuracy": rng.integers(0, 99999, n),
+            "voc": rng.integers(0, 500, n),
+            "voltage": rng.integers(90, 121, n),
+        }
+    )
@@ -6,6 +6,8 @@ import os
 import pandas as pd
 import pytest
 
+from ckan_server import FakeCkanServer
+
 DATA_DIR = Path(__file__).parent.resolve() / "data"
 FIETSERSBOND_DIR = (DATA_DIR / "Fietsersbond").resolve()
 TEST_DATA_PATH = (DATA_DIR / "test_data.csv").resolve()
@@ -24,6 +26,13 @@ def test_data() -> pd.DataFrame:
     return df
 
 
+@pytest.fixture
+def ckan_server():
+    """A local CKAN stand-in serving the test data."""
+    with FakeCkanServer(pd.read_csv(TEST_DATA_PATH)) as server:
+        yield server
+
+
 @pytest.fixture
 def tmp_wd(tmp_path):
     """Changes working directory and returns to previous on exit.
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import TEST_DATA_PATH
+from snuffelfiets import analyse
+
+
+@pytest.fixture
+def df_tijd():
+    df = pd.read_csv(TEST_DATA_PATH, index_col=0)
+    return analyse.bewerk_timestamp(df)
+
+
+def split_in_ritten_loop(df, t_seconden=1800):
+    """Reference: the per-entity loop that split_in_ritten replaced."""
+    df = df.copy()
+    df["duur"] = np.timedelta64(0, "s")
+    df["rit_id"] = 0
+    df["afstand"] = 0.0
+    for _, df_id in df.groupby("entity_id"):
+        duur = df_id["date_time"].diff().fillna(np.timedelta64(0, "s"))
+        rit_mask = duur >= pd.Timedelta(seconds=t_seconden)
+        duur[rit_mask] = np.timedelta64(0, "s")
+        afstand = analyse.haversine(
+            df_id.latitude,
+            df_id.longitude,
+            df_id.latitude.shift(),
+            df_id.longitude.shift(),
+        )
+        afstand[rit_mask] = 0.0
+        df.loc[df_id.index, "duur"] = duur
+        df.loc[df_id.index, "afstand"] = afstand
+        df.loc[df_id.index, "rit_id"] = (
+            df["rit_id"].max() + 1 + rit_mask.astype(int).cumsum()
+        )
+    df["snelheid"] = df["afstand"] / df["duur"].dt.total_seconds()
+    return df
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_split_in_ritten(df_tijd, shuffle):
+    df = df_tijd.sample(frac=1, random_state=1) if shuffle else df_tijd
+    df_ref = split_in_ritten_loop(df, t_seconden=600)
+    df_new = analyse.split_in_ritten(df.copy(), t_seconden=600)
+    assert df_new["rit_id"].nunique() > df_new["entity_id"].nunique()
+    for col in ["duur", "afstand", "snelheid", "rit_id"]:
+        pd.testing.assert_series_equal(df_new[col], df_ref[col], check_dtype=False)
+
+
+def test_geodesic_distance_matches_geopy():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = rng.uniform(-89, 89, (2, 200))
+    lon1, lon2 = rng.uniform(-180, 180, (2, 200))
+    # Short distances around Utrecht, coincident points and the equator
+    lat1[:50], lon1[:50] = 52.09 + rng.normal(0, 0.02, (2, 50))
+    lat2[:50], lon2[:50] = lat1[:50] + 1e-4, lon1[:50] - 2e-4
+    lat2[50], lon2[50] = lat1[50], lon1[50]
+    lat1[51] = lat2[51] = 0.0
+    # Nearly antipodal points fall back to geopy
+    lat1[52], lon1[52], lat2[52], lon2[52] = 0.0, 0.0, 0.5, 179.7
+
+    m = analyse.geodesic_distance(lat1, lon1, lat2, lon2)
+    expected = [
+        analyse.gd((a, b), (c, d)).m for a, b, c, d in zip(lat1, lon1, lat2, lon2)
+    ]
+    np.testing.assert_allclose(m, expected, rtol=0, atol=1e-3)
+    assert m[50] == 0.0
+
+    assert np.isnan(analyse.geodesic_distance([np.nan], [5.1], [52.1], [5.1])[0])
+
+
+def test_bereken_afstanden(df_tijd):
+    df = df_tijd.iloc[:500].copy()
+    df["duur"] = df.groupby("entity_id")["date_time"].diff()
+    df = analyse.bereken_afstanden(df)
+    expected = [
+        analyse.calculate_distance(*args)
+        for args in zip(
+            df.latitude,
+            df.longitude,
+            df.latitude.shift(),
+            df.longitude.shift(),
+            df["duur"],
+        )
+    ]
+    np.testing.assert_allclose(df["afstand_gd"], expected, rtol=0, atol=1e-3)
+    expected = [
+        analyse.calculate_distance_to_point(*args)
+        for args in zip(df.latitude, df.longitude)
+    ]
+    np.testing.assert_allclose(df["afstand_dom"], expected, rtol=0, atol=1e-3)
+
+
+def shares_data(df1, df2):
+    """Whether df2 is a new frame that shares the data of df1."""
+    return df1 is not df2 and np.shares_memory(
+        df1["_id"].to_numpy(), df2["_id"].to_numpy()
+    )
+
+
+def test_sort_skips_sorted_frames(df_tijd):
+    assert shares_data(df_tijd, analyse._sort(df_tijd))
+
+    df = df_tijd.sample(frac=1, random_state=1)
+    df_sorted = analyse._sort(df)
+    assert df_sorted is not df
+    pd.testing.assert_frame_equal(
+        df_sorted, df_tijd.sort_values(["entity_id", "date_time"], ignore_index=True)
+    )
+    # Sorted rows, but not a default index
+    assert analyse._sort(df_tijd.iloc[1:]) is not df_tijd
+    # Descending order
+    sortcols = {"entity_id": False, "date_time": True}
+    df_desc = analyse._sort(df_tijd, sortcols)
+    assert df_desc["entity_id"].is_monotonic_decreasing
+    assert shares_data(df_desc, analyse._sort(df_desc, sortcols))
+
+
+def test_verdeel_in_ritten(df_tijd):
+    df = analyse.verdeel_in_ritten(df_tijd.sample(frac=1, random_state=1))
+    assert df.index.equals(pd.RangeIndex(len(df)))
+    assert shares_data(df, analyse._sort(df))
+    duur = df.groupby("entity_id")["date_time"].diff().fillna(pd.Timedelta(0))
+    pd.testing.assert_series_equal(df["duur"], duur, check_names=False)
+    df_ritten = analyse.split_in_ritten(df.copy())
+    assert (
+        df["rit_id"] == df_ritten.groupby("entity_id")["rit_id"].rank("dense")
+    ).all()
+
+
+def test_verdeel_in_ritten_does_not_change_input(df_tijd):
+    columns = list(df_tijd.columns)
+    analyse.verdeel_in_ritten(df_tijd, split_timestamp=True)
+    analyse.aantal_ritten_per_persoon(df_tijd)
+    assert list(df_tijd.columns) == columns
+
+
+def test_aantal_ritten_per_persoon(df_tijd):
+    df = analyse.verdeel_in_ritten(df_tijd.copy(), t_seconden=600)
+    expected = [
+        [entity_id, df.loc[df["entity_id"] == entity_id, "rit_id"].iloc[-1]]
+        for entity_id in np.unique(df["entity_id"])
+    ]
+    data = analyse.aantal_ritten_per_persoon(df_tijd.copy())
+    assert data.shape == (10, 2)
+    data = analyse.aantal_ritten_per_persoon(df, herbereken=False)
+    np.testing.assert_array_equal(data, expected)
+
+    # Reuse the global rit_id of split_in_ritten
+    df = analyse.split_in_ritten(df, t_seconden=600)
+    np.testing.assert_array_equal(
+        analyse.aantal_ritten_per_persoon(df, herbereken=False), expected
+    )
+    assert analyse.aantal_ritten(df, herbereken=False) == df["rit_id"].nunique()
+
+
+def summary_stats_ref(df):
+    """Reference: summary_stats before the one-pass aggregation."""
+    N_fietsers = len(np.unique(df.entity_id))
+    N_ritten = len(np.unique(df.rit_id))
+    dft = df.groupby("entity_id")["rit_id"].nunique()
+    M_ritten = int(max(dft))
+    N_uren = df["duur"].sum() / np.timedelta64(1, "h")
+    dft = df.groupby("entity_id")["duur"].sum()
+    M_uren = int(max(dft / np.timedelta64(1, "h")))
+    N_km = df["afstand"].sum() / 1000
+    M_km = max(df.groupby("entity_id")["afstand"].sum()) / 1000
+    return {
+        "fietsers": {"N": N_fietsers, "G": None, "M": None},
+        "ritten": {"N": N_ritten, "G": N_ritten / N_fietsers, "M": M_ritten},
+        "uren": {"N": N_uren, "G": N_uren / N_fietsers, "M": M_uren},
+        "afstand": {"N": N_km, "G": N_km / N_fietsers, "M": M_km},
+    }
+
+
+def test_summary_stats(df_tijd):
+    df = analyse.bewerk_timestamp(df_tijd, split=True)
+    df = analyse.split_in_ritten(df, t_seconden=600)
+    stats = analyse.summary_stats(df, periods=["day", "week"])
+    assert set(stats["day"]) == set(df["day"])
+    for period, value, dfp in [(None, None, df)] + [
+        ("day", day, dfd) for day, dfd in df.groupby("day")
+    ]:
+        result = stats if period is None else stats["day"][value]
+        expected = summary_stats_ref(dfp)
+        for stat in expected:
+            for k, v in expected[stat].items():
+                assert result[stat][k] == pytest.approx(v)
+    assert list(stats["week"]) == [46]
+    assert stats["week"][46]["afstand"] == stats["afstand"]
+
+
+def test_summary_stats_datetime_period(df_tijd):
+    df = analyse.split_in_ritten(df_tijd, t_seconden=600)
+    df["datum"] = df["date_time"].dt.floor("D")
+    df["maand"] = df["date_time"].dt.to_period("M")
+    for periods in [["datum"], ["datum", "maand"]]:
+        stats = analyse.summary_stats(df, periods=periods)
+        assert set(stats["datum"]) == set(df["datum"])
+        assert stats["ritten"] == summary_stats_ref(df)["ritten"]
+    assert list(stats["maand"]) == [pd.Period("2024-11", "M")]
@@ -1,17 +1,30 @@
 # Tests inlezen.py
-# Note that we cannot test functions that need access to the database
-# We have not set up a dummy CKAN database to test that functionality
-# and the production database contains privacy-sensitive data
+# The production database contains privacy-sensitive data, so functions that
+# need access to the database are tested against a local stand-in for the
+# CKAN datastore_search_sql API, see ckan_server.py
 #
-# As of now, setting up this database is out-of-scope.
-# If this changes, see the following websites to get started with setting up a
-# database in GitHub Actions:
+# For a real CKAN database in GitHub Actions, see the following websites:
 #   https://docs.ckan.org/en/latest/maintaining/installing/index.html#
 #   https://github.com/Pooya-Oladazimi/ckanext-my-first-cool-extension/tree/main
+import json
+import os
+import time
+
 import numpy as np
+import pandas as pd
 import pytest
 
+from ckan_server import FakeCkanServer
+from conftest import TEST_DATA_PATH
+from snuffelfiets import opschonen
 from snuffelfiets.inlezen import *
+from snuffelfiets.inlezen import (
+    _date_conditions,
+    _day_bounds,
+    _is_immutable,
+    _select_columns,
+    _shard_bounds,
+)
 
 
 def test_is_date_matching():
@@ -43,6 +56,25 @@ def test_build_sql_statement_default():
     )
 
 
+def test_build_sql_statement_keyset():
+    statement = build_sql_statement(
+        datastore="ds",
+        conditions=[{"col": "recording_timestamp", "op": "<", "val": "2024-11-13"}],
+        parameters={"limit": 32000},
+        keyset=["recording_timestamp", "_id"],
+        after=["2024-11-12T08:00:00", 41415375],
+    )
+    assert (
+        statement
+        == 'SELECT * FROM "ds" WHERE "recording_timestamp" < \'2024-11-13\' AND ("recording_timestamp", "_id") > (\'2024-11-12T08:00:00\', \'41415375\') ORDER BY "recording_timestamp", "_id" LIMIT 32000'
+    )
+
+
+def test_build_sql_statement_no_conditions():
+    statement = build_sql_statement(datastore="ds", parameters={"limit": 10})
+    assert statement == 'SELECT * FROM "ds" LIMIT 10'
+
+
 def test_drop_columns_default(test_data):
     df = test_data
     assert "_full_text" in df.columns
@@ -66,3 +98,444 @@ def test_convert_to_int_default(test_data):
     df = convert_to_int(df)
     for column in ["entity_id", "version_major", "version_minor", "error_code"]:
         assert np.dtype("int64") is df["entity_id"].dtype
+
+
+def test_get_records_workers(ckan_server):
+    sql = build_sql_statement(parameters={"limit": 500}, keyset=KEYSET_COLUMNS)
+    records = {}
+    for workers in [1, 4]:
+        params = {"resource_id": "", "sql": sql}
+        records[workers] = get_records(
+            ckan_server.url, {}, params, limit=500, workers=workers
+        )
+    assert len(records[1]) == 5704
+    assert records[4] == records[1]
+
+
+def test_call_api_workers(ckan_server):
+    df = call_api(
+        "",
+        "2024-11-12",
+        "2024-11-13",
+        url=ckan_server.url,
+        sql_parameters={"limit": 1000},
+        workers=3,
+    )
+    assert df.shape[0] == 4818
+    assert "_full_text" not in df.columns
+    assert df["entity_id"].dtype == np.dtype("int64")
+
+
+def test_call_api_offset_windows_ordered(ckan_server):
+    client = CkanClient(ckan_server.url)
+    statements = []
+
+    def record_sql(params, get_chunk=client.get_chunk):
+        statements.append(params["sql"])
+        return get_chunk(params)
+
+    client.get_chunk = record_sql
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000}, workers=3)
+    df = call_api("", "2024-11-11", "2024-11-13", client=client, **kwargs)
+    assert df["_id"].is_unique
+    windows = [sql for sql in statements if " OFFSET " in sql]
+    assert len(windows) >= 2
+    for sql in windows:
+        assert 'ORDER BY "recording_timestamp", "_id" LIMIT 1000 OFFSET' in sql
+
+
+def test_records_to_frame_schema(ckan_server):
+    records, _ = ckan_server.query(f'SELECT * FROM "{ckan_server.datastore}"')
+    df = records_to_frame(records)
+    assert "_full_text" not in df.columns
+    for col, dtype in MEASUREMENT_SCHEMA.items():
+        if dtype == "datetime64":
+            assert pd.api.types.is_datetime64_any_dtype(df[col])
+        else:
+            assert df[col].dtype == np.dtype(dtype)
+    df_ref = pd.read_csv(TEST_DATA_PATH, index_col=0)
+    for col in ["entity_id", "error_code", "pm2_5", "latitude"]:
+        assert (df[col] == df_ref[col]).all()
+
+
+def test_records_to_frame_overflow_and_missing():
+    records = [
+        {"entity_id": "1", "pm2_5": 40000, "temperature": 185},
+        {"entity_id": "2", "pm2_5": 12, "temperature": None},
+    ]
+    df = records_to_frame(records)
+    assert df["entity_id"].dtype == np.dtype("int64")
+    assert df["pm2_5"].dtype == np.dtype("int64")
+    assert df["pm2_5"].iloc[0] == 40000
+    assert df["temperature"].dtype == np.dtype("float64")
+    assert np.isnan(df["temperature"].iloc[1])
+
+
+def test_records_to_frame_single_and_unknown_columns():
+    df = records_to_frame([{"pm2_5": 1}, {"pm2_5": 2}])
+    assert list(df["pm2_5"]) == [1, 2]
+    df = records_to_frame([{"t": "a", "pm2_5": 1}], drop=[])
+    assert list(df.columns) == ["t", "pm2_5"]
+    assert df["t"].iloc[0] == "a"
+    assert records_to_frame([]).empty
+
+
+def test_decode_json_fallback(monkeypatch):
+    body = json.dumps({"result": {"records": [{"_id": 1, "pm2_5": 3}]}}).encode()
+    expected = json.loads(body)
+    assert decode_json(body) == expected
+    monkeypatch.setattr("snuffelfiets.inlezen.orjson", None)
+    assert decode_json(body) == expected
+
+
+def test_call_api_keyset(ckan_server):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 700})
+    df_offset = call_api("", "2024-11-11", "2024-11-13", **kwargs)
+    df_keyset = call_api("", "2024-11-11", "2024-11-13", pagination="keyset", **kwargs)
+    assert df_keyset.shape == df_offset.shape
+    assert df_keyset["_id"].is_unique
+    assert set(df_keyset["_id"]) == set(df_offset["_id"])
+    keys = df_keyset[["recording_timestamp", "_id"]].apply(tuple, axis=1)
+    assert keys.is_monotonic_increasing
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+def test_stream_api(ckan_server, tmp_path, suffix):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000})
+    df = call_api("", "2024-11-11", "2024-11-13", **kwargs)
+    df = opschonen.correct_units(df)
+    path = tmp_path / f"api_gegevens{suffix}"
+    n_rows = stream_api("", "2024-11-11", "2024-11-13", path, **kwargs)
+    assert n_rows == df.shape[0]
+    if suffix == ".csv":
+        timestamps = ["recording_timestamp", "receive_timestamp"]
+        df_stream = pd.read_csv(path, parse_dates=timestamps)
+    else:
+        df_stream = pd.read_parquet(path)
+    pd.testing.assert_frame_equal(df_stream, df, check_dtype=False)
+
+
+def test_stream_api_parquet_overflow_in_later_chunk(tmp_path):
+    df_all = pd.read_csv(TEST_DATA_PATH)
+    df_all.loc[df_all.index[-1], "horizontal_accuracy"] = 3_000_000_000
+    path = tmp_path / "api_gegevens.parquet"
+    with FakeCkanServer(df_all) as server:
+        kwargs = dict(url=server.url, sql_parameters={"limit": 1000})
+        n_rows = stream_api("", "2024-11-01", "2024-12-01", path, **kwargs)
+    df = pd.read_parquet(path)
+    assert n_rows == df.shape[0] == df_all.shape[0]
+    assert df["horizontal_accuracy"].max() == 3_000_000_000
+
+
+def test_sync_csv(tmp_path):
+    df_all = pd.read_csv(TEST_DATA_PATH)
+    new = df_all["recording_timestamp"] >= "2024-11-12T12:00:00"
+    path = tmp_path / "api_gegevens_2024-11.csv"
+    kwargs = dict(sql_parameters={"limit": 1000})
+    with FakeCkanServer(df_all[~new]) as server:
+        n_old = sync_csv("", "2024-11-01", "2024-12-01", path, url=server.url, **kwargs)
+        server.insert(df_all[new])
+        n_new = sync_csv("", "2024-11-01", "2024-12-01", path, url=server.url, **kwargs)
+        n_none = sync_csv(
+            "", "2024-11-01", "2024-12-01", path, url=server.url, **kwargs
+        )
+    assert (n_old, n_new, n_none) == ((~new).sum(), new.sum(), 0)
+
+    df = pd.read_csv(path)
+    assert df["_id"].is_unique
+    assert set(df["_id"]) == set(df_all["_id"])
+    state = json.loads((tmp_path / "sync_state.json").read_text())
+    last = df_all.sort_values(["recording_timestamp", "_id"]).iloc[-1]
+    assert state[path.name] == [last["recording_timestamp"], int(last["_id"])]
+
+
+def test_sync_csv_resume(ckan_server, tmp_path):
+    path = tmp_path / "api_gegevens_2024-11.csv"
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000})
+    n_first = sync_csv("", "2024-11-01", "2024-11-12", path, **kwargs)
+
+    # Interrupt the next sync in the third chunk (the first call gets the columns)
+    client = CkanClient(ckan_server.url, retries=0)
+    calls = []
+
+    def fail_third(params, get_chunk=client.get_chunk):
+        calls.append(params)
+        if len(calls) == 4:
+            ckan_server.fail_next()
+        return get_chunk(params)
+
+    client.get_chunk = fail_third
+    with pytest.raises(ApiError):
+        sync_csv("", "2024-11-01", "2024-12-01", path, client=client, **kwargs)
+    assert pd.read_csv(path).shape[0] == n_first + 2000
+
+    n_rows = sync_csv("", "2024-11-01", "2024-12-01", path, **kwargs)
+    assert n_rows == 5704 - n_first - 2000
+    df = pd.read_csv(path)
+    assert df.shape[0] == 5704
+    assert df["_id"].is_unique
+
+
+def test_client_reuses_connections(ckan_server):
+    sql = build_sql_statement(parameters={"limit": 500})
+    with CkanClient(ckan_server.url) as client:
+        chunks = list(iter_chunks(client, {"sql": sql}, limit=500))
+    assert len(chunks) == 12
+    assert ckan_server.n_requests == 12
+    assert ckan_server.n_connections == 1
+
+
+def test_client_retries(ckan_server):
+    ckan_server.fail_next(2, status=503)
+    with CkanClient(ckan_server.url, retries=2, backoff=0.01) as client:
+        records = client.get_chunk(
+            {"sql": build_sql_statement(parameters={"limit": 5})}
+        )
+    assert len(records) == 5
+    assert ckan_server.n_requests == 1
+
+
+def test_client_gives_up(ckan_server):
+    ckan_server.fail_next(3, status=503)
+    with CkanClient(ckan_server.url, retries=2, backoff=0.01) as client:
+        with pytest.raises(ApiError, match="503"):
+            client.get_chunk({"sql": build_sql_statement(parameters={"limit": 5})})
+
+
+def test_client_no_retry_on_bad_request(ckan_server):
+    with CkanClient(ckan_server.url, retries=2, backoff=0.01) as client:
+        with pytest.raises(ApiError, match="409"):
+            client.get_chunk({"sql": "SELECT nonsense"})
+    assert ckan_server.n_requests == 1
+
+
+def test_call_api_resume(ckan_server):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000})
+    df_all = call_api("", "2024-11-11", "2024-11-13", pagination="keyset", **kwargs)
+
+    # Let the third chunk fail (the first call gets the columns)
+    client = CkanClient(ckan_server.url, retries=0)
+    calls = []
+
+    def fail_third(params, get_chunk=client.get_chunk):
+        calls.append(params)
+        if len(calls) == 4:
+            ckan_server.fail_next()
+        return get_chunk(params)
+
+    client.get_chunk = fail_third
+    with pytest.raises(ApiError) as excinfo:
+        call_api(
+            "", "2024-11-11", "2024-11-13", pagination="keyset", client=client, **kwargs
+        )
+    error = excinfo.value
+    assert len(error.records) == 2000
+
+    df_rest = call_api("", "2024-11-11", "2024-11-13", after=error.after, **kwargs)
+    df = pd.concat([records_to_frame(error.records), df_rest], ignore_index=True)
+    pd.testing.assert_frame_equal(df, df_all)
+
+
+def test_call_api_checkpointed(ckan_server, tmp_path):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000})
+    df_all = call_api("", "2024-11-10", "2024-11-13", **kwargs)
+    df_all = df_all.sort_values("_id", ignore_index=True)
+
+    # Interrupt the download in the second day (the first call gets the columns)
+    client = CkanClient(ckan_server.url, retries=0)
+    calls = []
+
+    def fail_second(params, get_chunk=client.get_chunk):
+        calls.append(params)
+        if len(calls) == 3:
+            ckan_server.fail_next()
+        return get_chunk(params)
+
+    client.get_chunk = fail_second
+    with pytest.raises(ApiError):
+        call_api_checkpointed(
+            "", "2024-11-10", "2024-11-13", tmp_path, client=client, **kwargs
+        )
+    state = json.loads((tmp_path / "checkpoints.json").read_text())
+    assert state == {"2024-11-10_2024-11-11": 0}
+
+    df = call_api_checkpointed("", "2024-11-10", "2024-11-13", tmp_path, **kwargs)
+    df = df.sort_values("_id", ignore_index=True)
+    pd.testing.assert_frame_equal(df, df_all)
+    state = json.loads((tmp_path / "checkpoints.json").read_text())
+    assert len(state) == 3
+    assert sum(state.values()) == df_all.shape[0]
+
+    # A restart skips all days with a valid checkpoint
+    n_requests = ckan_server.n_requests
+    df = call_api_checkpointed("", "2024-11-10", "2024-11-13", tmp_path, **kwargs)
+    assert ckan_server.n_requests == n_requests
+    assert df.shape[0] == df_all.shape[0]
+
+    # A checkpoint with the wrong row count is downloaded again
+    state["2024-11-12_2024-11-13"] += 1
+    (tmp_path / "checkpoints.json").write_text(json.dumps(state))
+    df = call_api_checkpointed("", "2024-11-10", "2024-11-13", tmp_path, **kwargs)
+    assert ckan_server.n_requests > n_requests
+    assert df.shape[0] == df_all.shape[0]
+
+
+@pytest.mark.parametrize(
+    "start, stop",
+    [
+        ("2024-11-11", "2024-11-12T12:00:00"),
+        ("2024-11-11T06:30:00", "2024-11-13"),
+        ("2024-11-12T06:00:00", "2024-11-12T18:00:00"),
+    ],
+)
+def test_call_api_checkpointed_times(ckan_server, tmp_path, start, stop):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000})
+    df_all = call_api("", start, stop, **kwargs)
+    assert df_all.shape[0] > 0
+    df = call_api_checkpointed("", start, stop, tmp_path, **kwargs)
+    pd.testing.assert_frame_equal(
+        df.sort_values("_id", ignore_index=True),
+        df_all.sort_values("_id", ignore_index=True),
+    )
+    # Checkpoint names contain no ":"
+    assert not [p for p in tmp_path.iterdir() if ":" in p.name]
+
+
+def test_day_bounds():
+    assert _day_bounds("2024-11-10", "2024-11-12") == [
+        "2024-11-10",
+        "2024-11-11",
+        "2024-11-12",
+    ]
+    assert _day_bounds("2024-11-10T06:00:00", "2024-11-11T12:00:00") == [
+        "2024-11-10T06:00:00",
+        "2024-11-11",
+        "2024-11-11T12:00:00",
+    ]
+    with pytest.raises(ValueError):
+        _day_bounds("2024-11-12", "2024-11-12")
+
+
+def test_count_records(ckan_server):
+    with CkanClient(ckan_server.url) as client:
+        counts = count_records(client, "2024-11-11", "2024-11-13")
+    assert counts.sum() == 5704
+    ts = pd.to_datetime(pd.read_csv(TEST_DATA_PATH)["recording_timestamp"])
+    assert (counts == ts.dt.floor("h").value_counts().sort_index()).all()
+
+
+def test_shard_bounds():
+    index = pd.date_range("2024-11-11T08:00:00", periods=3, freq="h")
+    counts = pd.Series([600, 300, 700], index=index)
+    shards = _shard_bounds(counts, "2024-11-11", "2024-11-12", limit=1000)
+    assert shards == [
+        ("2024-11-11", "2024-11-11T10:00:00"),
+        ("2024-11-11T10:00:00", "2024-11-12"),
+    ]
+    assert _shard_bounds(counts, "2024-11-11", "2024-11-12", limit=2000) == [
+        ("2024-11-11", "2024-11-12")
+    ]
+
+
+def test_call_api_sharded(ckan_server):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 500})
+    df_all = call_api("", "2024-11-11", "2024-11-13", **kwargs)
+    df = call_api_sharded("", "2024-11-11", "2024-11-13", workers=4, **kwargs)
+    keys = df[["recording_timestamp", "_id"]].apply(tuple, axis=1)
+    assert keys.is_monotonic_increasing
+    df_all = df_all.sort_values(["recording_timestamp", "_id"], ignore_index=True)
+    pd.testing.assert_frame_equal(df, df_all)
+
+
+@pytest.mark.parametrize("preset", ["full", "analysis", "routefilter"])
+def test_call_api_column_presets(ckan_server, preset):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000})
+    df = call_api("", "2024-11-11", "2024-11-13", columns=preset, **kwargs)
+    assert list(df.columns) == COLUMN_PRESETS[preset]
+    df_all = call_api("", "2024-11-11", "2024-11-13", columns="*", **kwargs)
+    pd.testing.assert_frame_equal(df, df_all[COLUMN_PRESETS[preset]])
+    # Columns that were not fetched are skipped
+    opschonen.correct_units(df)
+
+
+def test_call_api_full_keeps_unknown_columns(capsys):
+    df_all = pd.read_csv(TEST_DATA_PATH, index_col=0).assign(extra=1)
+    with FakeCkanServer(df_all) as server:
+        df = call_api("", "2024-11-11", "2024-11-13", url=server.url)
+    assert list(df.columns) == list(MEASUREMENT_SCHEMA) + ["extra"]
+    assert (df["extra"] == 1).all()
+    out = capsys.readouterr().out
+    assert "['extra'] are not in MEASUREMENT_SCHEMA" in out
+    assert "_full_text" not in out
+
+
+def test_column_presets_select_no_full_text():
+    for preset in COLUMN_PRESETS:
+        statement = build_sql_statement(columns=_select_columns(preset))
+        assert "_full_text" not in statement
+        assert '"recording_timestamp"' in statement and '"_id"' in statement
+
+
+def test_call_api_cache(ckan_server, tmp_path):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000}, workers=2)
+    df = call_api("", "2024-11-11", "2024-11-13", cache=tmp_path, **kwargs)
+    n_requests = ckan_server.n_requests
+    df_cached = call_api("", "2024-11-11", "2024-11-13", cache=tmp_path, **kwargs)
+    assert ckan_server.n_requests == n_requests
+    pd.testing.assert_frame_equal(df_cached, df)
+
+
+def test_call_api_cache_per_api_key(ckan_server, tmp_path):
+    kwargs = dict(url=ckan_server.url, sql_parameters={"limit": 1000}, cache=tmp_path)
+    call_api("key-a", "2024-11-11", "2024-11-13", **kwargs)
+    n_requests = ckan_server.n_requests
+    call_api("key-b", "2024-11-11", "2024-11-13", **kwargs)
+    assert ckan_server.n_requests > n_requests
+    n_requests = ckan_server.n_requests
+    call_api("key-a", "2024-11-11", "2024-11-13", **kwargs)
+    assert ckan_server.n_requests == n_requests
+
+
+def test_response_cache_ttl_and_eviction(tmp_path):
+    cache = ResponseCache(tmp_path, ttl=3600, max_bytes=25)
+    params = {"resource_id": "r", "sql": "SELECT *  FROM t WHERE x = 1"}
+    cache.put("url", params, b"0123456789")
+    same = {"resource_id": "r", "sql": "SELECT * FROM t\n WHERE x = 1;"}
+    assert cache.get("url", same) == b"0123456789"
+    assert cache.get("other", params) is None
+
+    # Expired
+    os.utime(cache.path("url", params), (0, 0))
+    assert cache.get("url", params) is None
+
+    # Least recently used responses are evicted above max_bytes
+    other = {"resource_id": "r", "sql": "SELECT 2"}
+    cache.put("url", params, b"0123456789")
+    cache.put("url", other, b"0123456789")
+    os.utime(cache.path("url", params), (0, time.time()))
+    cache.put("url", {"sql": "SELECT 3"}, b"0123456789")
+    assert cache.get("url", params) is None
+    assert cache.get("url", other) == b"0123456789"
+
+
+def test_is_immutable():
+    now = "2024-12-15"
+    sql = build_sql_statement(conditions=_date_conditions("2024-11-01", "2024-12-01"))
+    assert _is_immutable(sql, now)
+    assert not _is_immutable(sql, "2024-11-30")
+    sql = sql.replace("< '2024-12-01'", "<= '2024-12-01'")
+    assert not _is_immutable(sql, now)
+    assert not _is_immutable(build_sql_statement(), now)
+
+
+def test_monthly_csv_dump_stream_requires_no_preproc(tmp_path):
+    with pytest.raises(ValueError, match="preproc=False"):
+        monthly_csv_dump("", 2024, 11, tmp_path, stream=True)
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("mode", ["stream", "incremental"])
+def test_monthly_csv_dump_checkpoints_not_with_stream(tmp_path, mode):
+    kwargs = {mode: True, "preproc": False, "checkpoint_directory": tmp_path}
+    with pytest.raises(ValueError, match="checkpoint_directory"):
+        monthly_csv_dump("", 2024, 11, tmp_path, **kwargs)
@@ -0,0 +1,118 @@
+import pandas as pd
+import pytest
+
+from snuffelfiets import opschonen
+
+
+def test_critical_errors():
+    assert opschonen.CRITICAL_ERRORS == 1 + 4 + 8 + 16 + 512 + 1024 + 4096
+
+
+def test_verwijder_errors_mask(test_data):
+    df = test_data.copy()
+    df["error_code"] = [0, 32, 2048, 512, 32 + 512, 2048 + 4096, 34] * (
+        len(df) // 7
+    ) + [0] * (len(df) % 7)
+    df_mask = opschonen.verwijder_errors(df, error_mask=opschonen.CRITICAL_ERRORS)
+    codes = df_mask["error_code"].astype(int)
+    assert set(codes) == {0, 32, 2048, 34}
+    assert len(df_mask) == len(df) - 3 * (len(df) // 7)
+
+    # Exact codes only remove these codes, not compound codes with these bits
+    df_codes = opschonen.verwijder_errors(df, error_codes=[512, 4096])
+    assert set(df_codes["error_code"].astype(int)) == {0, 32, 2048, 544, 6144, 34}
+
+    # Without codes, all errors are removed
+    assert set(opschonen.verwijder_errors(df)["error_code"]) == {0}
+
+
+def test_error_breakdown(test_data):
+    codes = [0, 32, 2048, 512, 32 + 512, 2048 + 4096, 34] * (len(test_data) // 7)
+    df = test_data.iloc[: len(codes)].assign(error_code=codes)
+
+    df_codes = opschonen.error_breakdown(df)
+    assert list(df_codes.columns) == [
+        "error_code",
+        "count",
+        "error_bit",
+        "description",
+        "type",
+    ]
+    for code, df_code in df_codes.groupby("error_code"):
+        assert list(df_code["error_bit"]) == (opschonen.split_error_code(code) or [0])
+        assert (df_code["count"] == codes.count(code)).all()
+    assert df_codes.loc[df_codes["error_bit"] == 0, "description"].item() == "No Error"
+
+    df_bits = opschonen.error_breakdown(df, per="bit").set_index("error_bit")
+    assert len(df_bits) == 16
+    n = len(df) // 7
+    assert df_bits.loc[32, "count"] == 3 * n
+    assert df_bits.loc[4096, "count"] == n
+    assert df_bits.loc[2, "count"] == n
+    assert df_bits.loc[1, "count"] == 0
+    assert df_bits.loc[512, "type"] == "Critical Error"
+
+
+def test_analyse_errors(test_data, capsys):
+    opschonen.analyse_errors(test_data.assign(error_code=2048 + 32))
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == f"code {2080:10}: count {len(test_data):15}"
+    assert len(out) == 5
+    assert "No GPS Fix" in out[2]
+
+
+def test_correct_units(test_data):
+    df_raw = test_data.copy()
+    df = opschonen.correct_units(test_data)
+    assert df is test_data
+    assert df.attrs["correct_units"] == list(opschonen.CORRECTIE_DEFAULTS)
+
+    # Unconditional corrections
+    assert (df["temperature"] == df_raw["temperature"] * 0.1).all()
+    assert (df["voltage"] == 3 + df_raw["voltage"] * 0.1).all()
+    # Conditional corrections
+    v2 = df_raw["version_major"].astype(int) >= 2
+    assert v2.any() and (~v2).any()
+    assert (df.loc[v2, "pm2_5"] == df_raw.loc[v2, "pm2_5"] * 0.01).all()
+    assert (df.loc[~v2, "pm2_5"] == df_raw.loc[~v2, "pm2_5"]).all()
+
+
+def test_correct_units_unconditional(test_data):
+    # Corrections without a conditie apply to every row (before, their mask
+    # was all False and they were never applied)
+    df_raw = test_data.copy()
+    df = opschonen.correct_units(test_data, {"humidity": {"factor": 2.0}})
+    assert (df["humidity"] == df_raw["humidity"] * 2).all()
+    df = opschonen.correct_units(test_data)
+    assert df["temperature"].between(-30, 50).all()
+    assert df["pressure"].between(90_000, 110_000).all()
+
+
+def test_correct_units_twice(test_data, tmp_path):
+    df = opschonen.correct_units(test_data)
+    temperature = df["temperature"].copy()
+    with pytest.raises(ValueError, match="already been corrected"):
+        opschonen.correct_units(df)
+    assert (df["temperature"] == temperature).all()
+
+    # The record survives copies, slices and Parquet files
+    with pytest.raises(ValueError):
+        opschonen.correct_units(df.iloc[:10].copy())
+    p = tmp_path / "df.parquet"
+    df.to_parquet(p)
+    with pytest.raises(ValueError):
+        opschonen.correct_units(pd.read_parquet(p))
+
+    # Unless forced, or for other columns
+    correcties = {"no2": {"factor": 2.0}}
+    df = opschonen.correct_units(df, correcties)
+    assert df.attrs["correct_units"][-1] == "no2"
+    df = opschonen.correct_units(df, force=True)
+    assert (df["temperature"] == temperature * 0.1).all()
+
+
+def test_correct_units_missing_condition_column(test_data):
+    df = test_data.drop(columns=["version_major"])
+    df = opschonen.correct_units(df)
+    assert "pm2_5" not in df.attrs["correct_units"]
+    assert "temperature" in df.attrs["correct_units"]
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from conftest import TEST_DATA_PATH
+from snuffelfiets import opslag
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    df = pd.read_csv(TEST_DATA_PATH, index_col=0)
+    opslag.write_partition(df, tmp_path, 2024, 11)
+    # Fake a second month by shifting the timestamps
+    df_oct = df.copy()
+    ts = pd.to_datetime(df_oct["recording_timestamp"]) - pd.Timedelta(days=31)
+    df_oct["recording_timestamp"] = ts.dt.strftime("%Y-%m-%dT%H:%M:%S")
+    opslag.write_partition(df_oct, tmp_path, 2024, 10)
+    return tmp_path, df
+
+
+def test_write_partition_layout(dataset):
+    data_directory, df = dataset
+    p = opslag.partition_directory(data_directory, 2024, 11)
+    assert p == data_directory / "api_gegevens" / "year=2024" / "month=11"
+    assert list(p.glob("*.parquet")) == [p / "part-0.parquet"]
+
+
+def test_write_partition_overwrites(dataset):
+    data_directory, df = dataset
+    opslag.write_partition(df.iloc[:10], data_directory, 2024, 11)
+    df_read = opslag.read_dataset(data_directory, months=[11])
+    assert df_read.shape[0] == 10
+
+
+def test_read_dataset_typed(dataset):
+    data_directory, df = dataset
+    df_read = opslag.read_dataset(data_directory)
+    assert df_read.shape[0] == 2 * df.shape[0]
+    assert pd.api.types.is_datetime64_any_dtype(df_read["recording_timestamp"])
+    assert df_read["entity_id"].dtype == df["entity_id"].dtype
+
+
+def test_read_dataset_columns_and_months(dataset):
+    data_directory, df = dataset
+    columns = ["entity_id", "recording_timestamp", "pm2_5"]
+    df_read = opslag.read_dataset(data_directory, columns=columns, months=[10])
+    assert list(df_read.columns) == columns
+    assert df_read.shape[0] == df.shape[0]
+    assert (df_read["recording_timestamp"] < "2024-11-01").all()
+
+
+def test_read_dataset_date_range(dataset):
+    data_directory, df = dataset
+    df_read = opslag.read_dataset(
+        data_directory, start_datum="2024-10-12", stop_datum="2024-11-12"
+    )
+    ts = df["recording_timestamp"]
+    n_nov = (ts < "2024-11-12").sum()
+    n_oct = (ts >= "2024-11-12").sum()
+    assert df_read.shape[0] == n_nov + n_oct
+    assert df_read["recording_timestamp"].min() >= pd.Timestamp("2024-10-12")
+    assert df_read["recording_timestamp"].max() < pd.Timestamp("2024-11-12")
@@ -1,9 +1,13 @@
 from pathlib import Path
 import shutil
+import numpy as np
+import pandas as pd
 import pytest
 from _pytest._py.path import LocalPath
 
-from conftest import FIETSERSBOND_DIR, DATA_DIR
+from conftest import FIETSERSBOND_DIR, DATA_DIR, TEST_DATA_PATH
+from snuffelfiets import opslag
+from snuffelfiets.analyse import geodesic_distance
 from snuffelfiets import routefilter as rf
 
 
@@ -34,5 +38,125 @@ def test_filter_routes(tmpdir: LocalPath, test_data_copy):
         ), "Number of output CSVs is not equal to expected amount of files"
 
 
+def test_read_data_parquet(tmp_path):
+    df = pd.read_csv(TEST_DATA_PATH, index_col=0)
+    df.to_csv(tmp_path / "mcu_gegevens_2024-11.csv", index=False)
+    opslag.write_partition(df, tmp_path, 2024, 11, prefix="mcu_gegevens")
+    columns = ["entity_id", "recording_timestamp", "latitude", "longitude"]
+    kwargs = dict(data_directory=tmp_path, years=[2024], months=[11], columns=columns)
+    df_csv = rf.read_data(**kwargs)
+    df_parquet = rf.read_data(fmt="parquet", **kwargs)
+    assert df_parquet.shape[0] == df_csv.shape[0]
+    assert (df_parquet["yLat"] == df_csv["yLat"]).all()
+    assert (df_parquet["rit_id"] == df_csv["rit_id"]).all()
+
+
+def latlon(x, y, origin=rf.origin_default):
+    """Invert rf.project_enu, for meters (x, y) from origin."""
+    lat = np.full(np.shape(x), origin[0])
+    lon = np.full(np.shape(x), origin[1])
+    for _ in range(10):
+        xp, yp = rf.project_enu(lat, lon, origin)
+        lat += (y - yp) * rf.latMeter
+        lon += (x - xp) * rf.lonMeter
+    return lat, lon
+
+
+def route_and_points(points):
+    """An L-shaped route of 100 + 100 m and measurements at (x, y) meters."""
+    x0, y0 = 1000.0, -2000.0
+    lat, lon = latlon(x0 + np.array([0, 100, 100]), y0 + np.array([0, 0, 100]))
+    dfR = pd.DataFrame({"latitude": lat, "longitude": lon})
+    x, y = np.array(points, dtype=float).T
+    lat, lon = latlon(x0 + x, y0 + y)
+    df = pd.DataFrame({"latitude": lat, "longitude": lon})
+    df["xLon"], df["yLat"] = rf.project_enu(df["latitude"], df["longitude"])
+    df["id"] = np.arange(len(df))
+    return dfR, df
+
+
+def test_filter_routes_segments(tmp_path):
+    points = [(95, 50), (50, 5), (50, -15), (105, 5), (10, -3), (-5, 0), (100, 130)]
+    dfR, df = route_and_points(points)
+    rf.filter_routes([dfR], ["route.csv"], df, output_directory=tmp_path)
+    dfO = pd.read_csv(next(tmp_path.glob("*-dfOutput-route.csv")))
+    # Ordered by segment, then by the order in df
+    assert list(dfO["id"]) == [1, 3, 4, 0]
+    assert list(dfO["routeSegment"]) == [1, 1, 1, 2]
+    np.testing.assert_allclose(dfO["M-BE"], [5, 5, 3, 5], atol=1e-6)
+    np.testing.assert_allclose(dfO["distRoute"], [50, 105, 10, 150], atol=1e-6)
+
+
+def test_filter_routes_points_on_route(tmp_path):
+    # Points exactly on the route line and on the begin point are matched
+    dfR, df = route_and_points([(0, 0), (30, 0), (100, 40)])
+    rf.filter_routes([dfR], ["route.csv"], df, output_directory=tmp_path)
+    dfO = pd.read_csv(next(tmp_path.glob("*-dfOutput-route.csv")))
+    assert list(dfO["id"]) == [0, 1, 2]
+    np.testing.assert_allclose(dfO["M-BE"], 0, atol=1e-6)
+    assert not dfO[["MB", "ME", "aMB", "aME"]].isna().any().any()
+
+
+def test_filter_routes_multiple_routes(tmp_path):
+    points = [(95, 50), (50, 5), (50, -15), (105, 5), (10, -3), (30, 95)]
+    dfR, df = route_and_points(points)
+    # A second route that overlaps the first: the top of the L, reversed
+    dfR2 = dfR.iloc[::-1].reset_index(drop=True)
+    rf.filter_routes([dfR.copy(), dfR2.copy()], ["a.csv", "b.csv"], df, tmp_path)
+    for route, dfR_route in [("a.csv", dfR), ("b.csv", dfR2)]:
+        p_single = tmp_path / "single" / route
+        rf.filter_routes([dfR_route.copy()], [route], df, p_single.parent)
+        dfO = pd.read_csv(next(tmp_path.glob(f"*-dfOutput-{route}")))
+        dfO_single = pd.read_csv(next(p_single.parent.glob(f"*-dfOutput-{route}")))
+        pd.testing.assert_frame_equal(dfO, dfO_single)
+        assert len(dfO) == 4
+
+
+def test_filter_routes_does_not_change_inputs(tmp_path):
+    dfR, df = route_and_points([(95, 50), (50, 5), (500, 500)])
+    dfR_before, df_before = dfR.copy(), df.copy()
+    rf.filter_routes([dfR], ["route.csv"], df, output_directory=tmp_path)
+    pd.testing.assert_frame_equal(dfR, dfR_before)
+    pd.testing.assert_frame_equal(df, df_before)
+
+
+def test_match_routes_compact():
+    points = [(95, 50), (50, 5), (50, -15), (105, 5), (10, -3), (500, 500)]
+    dfR, df = route_and_points(points)
+    # Rows are positions in df, also with an index that is not a range
+    df.index = df.index * 10 + 7
+    (match,) = rf.match_routes([dfR], df)
+    assert list(match.columns) == ["row", "routeSegment", "M-BE", "distRoute"]
+    assert list(match["row"]) == [1, 3, 4, 0]
+    assert list(match["routeSegment"]) == [1, 1, 1, 2]
+    np.testing.assert_allclose(match["distRoute"], [50, 105, 10, 150], atol=1e-6)
+
+    dfO = rf.materialize(df, match)
+    assert list(dfO["id"]) == [1, 3, 4, 0]
+    assert list(dfO.columns[-3:]) == ["routeSegment", "M-BE", "distRoute"]
+
+
+@pytest.mark.parametrize("origin", [rf.origin_default, (43.7, 7.26)])
+def test_project_enu_distances(origin):
+    rng = np.random.default_rng(0)
+    lat = origin[0] + rng.normal(0, 0.1, 100)
+    lon = origin[1] + rng.normal(0, 0.1, 100)
+    lat2, lon2 = lat + rng.normal(0, 1e-4, 100), lon + rng.normal(0, 1e-4, 100)
+    x, y = rf.project_enu(lat, lon, origin)
+    x2, y2 = rf.project_enu(lat2, lon2, origin)
+    expected = geodesic_distance(lat, lon, lat2, lon2)
+    np.testing.assert_allclose(np.hypot(x2 - x, y2 - y), expected, rtol=1e-4)
+    np.testing.assert_allclose(rf.project_enu(*origin, origin), 0, atol=1e-9)
+
+
+def test_project_on_segments_block():
+    x, y = np.array([[0.0], [3.0], [-1.0]]), np.array([[4.0], [4.0], [0.0]])
+    xB, yB = np.array([[0.0, 1.0]]), np.array([[0.0, 1.0]])
+    ux, uy = np.array([[1.0, 0.0]]), np.array([[0.0, 1.0]])
+    perpendicular, along = rf.project_on_segments(x, y, xB, yB, ux, uy)
+    np.testing.assert_allclose(perpendicular, [[4, 1], [4, 2], [0, 2]])
+    np.testing.assert_allclose(along, [[0, 3], [3, 3], [-1, -1]])
+
+
 if __name__ == "__main__":
     test_filter_routes()